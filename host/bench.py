@@ -0,0 +1,234 @@
+"""Timing benchmarks for the sequencer firmware, run on the host stand-ins.
+
+    python -m host.bench                  # src/main.py and src/main_v2.py
+    python -m host.bench --ms 30000 src/main_v2.py
+
+Every scenario runs on each firmware file and reports, per MIDI port:
+
+    jitter  peak to peak / rms deviation of step onsets from the ideal grid
+    length  mean / max error of note lengths against the nominal gate
+    skew    mean / max spread of onsets of tracks that share a step
+    msg/s   MIDI messages per second, clock ticks included
+
+and per run the event loop utilization (time spent not sleeping), the
+latency from a key press or a sync pulse to its note and the I2C traffic.
+All times are in ms of virtual time, see host/sim.py for the cost model.
+"""
+import argparse
+import contextlib
+import io
+import math
+import os
+
+from . import sim
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SRC = os.path.join(_HERE, "..", "src")
+
+E1M1 = (28, 40, 52, 28, 40, 50, 28, 40, 48, 28, 40, 46, 28, 40, 47, 48)
+# key_number of the function keys and piano keys used by the scenarios
+KEY_RECORD = 3
+KEY_STEP = 2
+KEY_C = 9
+KEY_E = 18
+OCTAVE = 5
+PIANO = {KEY_C: 0, KEY_E: 4}
+WARMUP_MS = 300
+
+
+class Scenario:
+    def __init__(self, name, tempo, steps_per_beat, tracks, keys=(), pins=None):
+        self.name = name
+        self.tempo = tempo
+        self.steps_per_beat = steps_per_beat
+        # (notes of the 16 steps, mode) per track, mode 2 plays triplets
+        self.tracks = tracks
+        self.keys = keys
+        self.pins = pins or {}
+
+    @property
+    def period(self):
+        return 60000.0 / self.tempo / self.steps_per_beat
+
+    def configure(self, ns):
+        # main_v2.py counts steps per beat as a power of two, main.py does not
+        if "_pattern" in ns:
+            ns["_tempo"] = self.tempo
+            ns["_notes_per_beat"] = int(math.log2(self.steps_per_beat))
+            for t in range(len(ns["_pattern"])):
+                ns["reset_track"](t)
+            for t, (notes, mode) in enumerate(self.tracks):
+                for s, n in enumerate(notes):
+                    ns["set_step"](t, s, n, 127, 0, mode)
+        else:
+            ns["tempo"] = self.tempo
+            ns["notes_per_beat"] = self.steps_per_beat
+            for t in range(len(ns["data"])):
+                ns["reset_track"](t)
+            for t, (notes, mode) in enumerate(self.tracks):
+                for s, n in enumerate(notes):
+                    ns["data"][t][s] = (n, 127, 0, mode)
+
+
+def _press(t, key, hold=40):
+    return [(t, key, True), (t + hold, key, False)]
+
+
+def _record_keys(ms):
+    keys = _press(100, KEY_RECORD)
+    for i, t in enumerate(range(400, ms, 150)):
+        keys += _press(t, KEY_C if i % 2 else KEY_E, 60)
+    return keys
+
+
+def _sync_pulses(ms, every):
+    levels = []
+    for t in range(500, ms, every):
+        levels += [(t, False), (t + 2, True)]
+    return levels
+
+
+def scenarios(ms):
+    triplets = [(tuple(60 + 12 * t + (s % 4) for s in range(16)), 2) for t in range(4)]
+    return [
+        Scenario("e1m1 120", 120, 4, [(E1M1, 0)]),
+        Scenario("e1m1 180", 180, 4, [(E1M1, 0)]),
+        Scenario("e1m1 240", 240, 4, [(E1M1, 0)]),
+        Scenario("triplets 4trk", 120, 16, triplets),
+        Scenario("record+display", 120, 4, [(E1M1, 0)], keys=_record_keys(ms)),
+        Scenario("ext sync", 120, 4, [(E1M1, 0)], keys=_press(100, KEY_STEP),
+                 pins={"GP22": _sync_pulses(ms, 125)}),
+    ]
+
+
+def _notes(run, port):
+    """Pair note ons and offs per (channel, note), (note, on, off) in ms."""
+    pending = dict()
+    notes = []
+    for t, m in run.midi(port):
+        kind = m[0] & 0xF0
+        if kind not in (0x80, 0x90) or len(m) < 3:
+            continue
+        key = (m[0] & 0x0F, m[1])
+        if kind == 0x90 and m[2]:
+            pending.setdefault(key, []).append(t / 1e6)
+        elif pending.get(key):
+            notes.append((m[1], pending[key].pop(0), t / 1e6))
+    return sorted(notes, key=lambda n: n[1])
+
+
+def _stats(values):
+    if not values:
+        return None
+    return sum(values) / len(values), max(values)
+
+
+def analyse(run, scenario, port):
+    period = scenario.period
+    track_of = dict()
+    for t, (notes, mode) in enumerate(scenario.tracks):
+        for n in notes:
+            track_of[n] = (t, mode)
+
+    hits = dict()
+    for note, on, off in _notes(run, port):
+        if note in track_of:
+            t, mode = track_of[note]
+            hits.setdefault(t, []).append((on, off, mode))
+
+    deviations = []
+    length_errors = []
+    by_step = dict()
+    for t, track_hits in hits.items():
+        mode = track_hits[0][2]
+        per_step = 3 if mode == 2 else 1
+        nominal = period if per_step == 1 else 0.9 * period / 3
+        for on, off, _ in track_hits:
+            if on >= WARMUP_MS:
+                length_errors.append(abs(off - on - nominal))
+        # Counted from the first note, so that the stride stays on the first
+        # hit of every step
+        onsets = [h[0] for h in track_hits[::per_step] if h[0] >= WARMUP_MS]
+        if not onsets:
+            continue
+        origin = onsets[0]
+        for on in onsets:
+            k = round((on - origin) / period)
+            deviations.append(on - origin - k * period)
+            by_step.setdefault(k, []).append(on)
+
+    result = dict()
+    if deviations:
+        mean = sum(deviations) / len(deviations)
+        result["jitter"] = (max(deviations) - min(deviations),
+                            math.sqrt(sum((d - mean) ** 2 for d in deviations) / len(deviations)))
+    result["length"] = _stats(length_errors)
+    result["skew"] = _stats([max(v) - min(v) for v in by_step.values() if len(v) > 1])
+    seconds = run.duration_ms / 1000.0
+    result["msg/s"] = len(run.midi(port)) / seconds
+    return result
+
+
+def latencies(run, scenario, port="usb"):
+    ons = [(on, note) for note, on, off in _notes(run, port)]
+    lat = []
+    for t, key, pressed in scenario.keys:
+        if pressed and key in PIANO:
+            note = PIANO[key] + OCTAVE * 12
+            after = [on for on, n in ons if n == note and on >= t]
+            if after:
+                lat.append(after[0] - t)
+    sequenced = set(n for notes, mode in scenario.tracks for n in notes)
+    for t, level in scenario.pins.get("GP22", ()):
+        if not level:
+            after = [on for on, n in ons if n in sequenced and on >= t]
+            if after and after[0] - t < scenario.period:
+                lat.append(after[0] - t)
+    return _stats(lat)
+
+
+def _fmt(pair, digits=2):
+    if pair is None:
+        return "-"
+    return "{:.{d}f}/{:.{d}f}".format(pair[0], pair[1], d=digits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sequencer timing benchmarks")
+    parser.add_argument("firmware", nargs="*", default=[
+        os.path.join(_SRC, "main.py"), os.path.join(_SRC, "main_v2.py")])
+    parser.add_argument("--ms", type=int, default=20000, help="virtual run time per scenario")
+    parser.add_argument("--only", help="run scenarios whose name contains this")
+    args = parser.parse_args()
+
+    header = "{:<15} {:<11} {:<5} {:>13} {:>13} {:>13} {:>8} {:>6} {:>13} {:>8}".format(
+        "scenario", "firmware", "port", "jitter pp/rms", "length mn/mx", "skew mn/mx",
+        "msg/s", "util%", "latency mn/mx", "i2c B/s")
+    print(header)
+    print("-" * len(header))
+    for scenario in scenarios(args.ms):
+        if args.only and args.only not in scenario.name:
+            continue
+        for firmware in args.firmware:
+            name = os.path.basename(firmware)
+            try:
+                # the firmware's own prints would break up the table
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run = sim.run(firmware, args.ms, keys=scenario.keys, pins=scenario.pins,
+                                  on_start=scenario.configure)
+            except Exception as e:
+                print("{:<15} {:<11} failed: {!r}".format(scenario.name, name, e))
+                continue
+            seconds = args.ms / 1000.0
+            util = 100.0 * run.busy_ns / (args.ms * 1e6)
+            i2c = run.recorders["i2c"].bytes / seconds if "i2c" in run.recorders else 0
+            latency = _fmt(latencies(run, scenario), 1)
+            for port in ("uart", "usb"):
+                r = analyse(run, scenario, port)
+                print("{:<15} {:<11} {:<5} {:>13} {:>13} {:>13} {:>8.1f} {:>6.1f} {:>13} {:>8.0f}".format(
+                    scenario.name, name, port, _fmt(r.get("jitter")), _fmt(r["length"]),
+                    _fmt(r["skew"]), r["msg/s"], util, latency, i2c))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+# Replaces the gc module while firmware runs. Allocation is not modelled,
+# a collection is charged sim.GC_NS and the heap never fills up.
+import _hostsim as sim
+
+HEAP_BYTES = 192 * 1024
+
+
+def collect():
+    sim.gc_collections += 1
+    sim.advance(sim.GC_NS)
+
+
+def mem_alloc():
+    return 0
+
+
+def mem_free():
+    return HEAP_BYTES
+
+
+def enable():
+    pass
+
+
+def disable():
+    pass
+
+
+def isenabled():
+    return True
@@ -0,0 +1,117 @@
+# Shared state of the host stand-ins: the virtual clock, the scripted inputs
+# and the recordings of everything the firmware sent to the hardware.
+
+
+class SimulationEnd(Exception):
+    pass
+
+
+# Cost model, every blocking hardware call moves the virtual clock forward
+TASK_SWITCH_NS = 30000
+POLL_NS = 200000
+USB_WRITE_NS = 40000
+USB_BYTE_NS = 1000
+NVM_WRITE_NS = 45000000
+GC_NS = 3000000
+
+now_ns = 0
+limit_ns = None
+busy_ns = 0
+gc_collections = 0
+on_start = None
+_started = False
+scripted_keys = []
+scripted_pins = dict()
+uart_rx = []
+usb_rx = []
+recorders = []
+nvm_image = None
+
+
+def reset(duration_ms=None):
+    global now_ns, limit_ns, busy_ns, gc_collections, on_start, _started, nvm_image
+    now_ns = 0
+    nvm_image = None
+    busy_ns = 0
+    gc_collections = 0
+    on_start = None
+    _started = False
+    limit_ns = None if duration_ms is None else duration_ms * 1000000
+    del scripted_keys[:]
+    del uart_rx[:]
+    del usb_rx[:]
+    del recorders[:]
+    scripted_pins.clear()
+
+
+def advance(ns, busy=True):
+    global now_ns, busy_ns
+    ns = int(ns)
+    if limit_ns is not None and now_ns + ns >= limit_ns:
+        if busy:
+            busy_ns += limit_ns - now_ns
+        now_ns = limit_ns
+        raise SimulationEnd()
+    now_ns += ns
+    if busy:
+        busy_ns += ns
+
+
+def advance_to(t_ns, busy=True):
+    if t_ns > now_ns:
+        advance(t_ns - now_ns, busy)
+
+
+def start(namespace):
+    # Called with the firmware's globals the first time it enters its main
+    # loop, on_start can adjust settings that have no key binding
+    global _started
+    if not _started:
+        _started = True
+        if on_start is not None:
+            on_start(namespace)
+
+
+def now_ms():
+    return now_ns // 1000000
+
+
+def pin_value(name, default=True):
+    # A pin script is a sorted list of (time_ms, value) pairs
+    value = default
+    for t, v in scripted_pins.get(name, ()):
+        if t > now_ms():
+            break
+        value = v
+    return value
+
+
+def pin_edges(name, since_ms, until_ms):
+    previous = True
+    for t, v in scripted_pins.get(name, ()):
+        if since_ms < t <= until_ms and v != previous:
+            yield t, v
+        previous = v
+
+
+class Recorder:
+    def __init__(self, name):
+        self.name = name
+        self.writes = []
+        self.bytes = 0
+        self.calls = 0
+        # Time per byte on the wire, 0 for ports that take a buffer at once
+        self.byte_ns = 0
+        recorders.append(self)
+
+    def record(self, t_ns, data):
+        self.writes.append((t_ns, bytes(data)))
+        self.bytes += len(data)
+        self.calls += 1
+
+
+def recorder(name):
+    for r in recorders:
+        if r.name == name:
+            return r
+    return None
@@ -0,0 +1,25 @@
+# Replaces the time module while firmware runs, busy loops polling the
+# clock are charged sim.POLL_NS per call so they make progress
+import sys
+import time as _real_time
+
+import _hostsim as sim
+
+
+def monotonic():
+    sim.start(sys._getframe(1).f_globals)
+    sim.advance(sim.POLL_NS)
+    return sim.now_ns / 1000000000
+
+
+def monotonic_ns():
+    sim.advance(sim.POLL_NS)
+    return sim.now_ns
+
+
+def sleep(s):
+    sim.advance(s * 1000000000, busy=False)
+
+
+def __getattr__(name):
+    return getattr(_real_time, name)
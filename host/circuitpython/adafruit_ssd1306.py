@@ -0,0 +1,163 @@
+# SSD1306_I2C with the framebuffer layout and bus traffic of the Adafruit
+# driver. The panel side is modelled too, so partial updates can be checked
+# against the framebuffer.
+
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
+
+class _Panel:
+    def __init__(self, width, pages):
+        self.width = width
+        self.pages = pages
+        self.ram = bytearray(width * pages)
+        self.col = (0, width - 1)
+        self.page = (0, pages - 1)
+        self.x = 0
+        self.p = 0
+        self.args = []
+        self.frames = 0
+
+    def _command(self, cmd):
+        if self.args:
+            self.args.append(cmd)
+            if len(self.args) == 3:
+                op, a, b = self.args
+                self.args = []
+                if op == SET_COL_ADDR:
+                    self.col = (a, b)
+                    self.x = a
+                else:
+                    self.page = (a, b)
+                    self.p = a
+        elif cmd in (SET_COL_ADDR, SET_PAGE_ADDR):
+            self.args = [cmd]
+
+    def __call__(self, data):
+        if data[0] == 0x80:
+            for i in range(1, len(data), 2):
+                self._command(data[i])
+            return
+        if data[0] == 0x00:
+            for b in data[1:]:
+                self._command(b)
+            return
+        if data[0] != 0x40:
+            return
+        self.frames += 1
+        for b in data[1:]:
+            self.ram[self.p * self.width + self.x] = b
+            self.x += 1
+            if self.x > self.col[1]:
+                self.x = self.col[0]
+                self.p += 1
+                if self.p > self.page[1]:
+                    self.p = self.page[0]
+
+
+class _I2CDevice:
+    def __init__(self, i2c, address):
+        self.i2c = i2c
+        self.device_address = address
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, buf, *, start=0, end=None):
+        self.i2c.writeto(self.device_address, buf, start=start, end=end)
+
+
+def _glyph(ch, column):
+    if ch == " ":
+        return 0
+    return (ord(ch) * 2654435761 >> (column * 5)) & 0xFF | 1
+
+
+class SSD1306_I2C:
+    def __init__(self, width, height, i2c, *, addr=0x3C, external_vcc=False, reset=None, page_addressing=False):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.addr = addr
+        self.page_addressing = page_addressing
+        self.temp = bytearray(2)
+        self.buffer = bytearray(self.pages * width + 1)
+        self.buffer[0] = 0x40
+        self._fb = memoryview(self.buffer)[1:]
+        self.i2c_device = _I2CDevice(i2c, addr)
+        self.panel = _Panel(width, self.pages)
+        i2c.devices[addr] = self.panel
+
+    def write_cmd(self, cmd):
+        self.temp[0] = 0x80
+        self.temp[1] = cmd
+        with self.i2c_device:
+            self.i2c_device.write(self.temp)
+
+    def write_framebuf(self):
+        with self.i2c_device:
+            self.i2c_device.write(self.buffer)
+
+    def show(self):
+        self.write_cmd(SET_COL_ADDR)
+        self.write_cmd(0)
+        self.write_cmd(self.width - 1)
+        self.write_cmd(SET_PAGE_ADDR)
+        self.write_cmd(0)
+        self.write_cmd(self.pages - 1)
+        self.write_framebuf()
+
+    def fill(self, color):
+        v = 0xFF if color else 0
+        for i in range(len(self._fb)):
+            self._fb[i] = v
+
+    def pixel(self, x, y, color=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        index = (y >> 3) * self.width + x
+        bit = 1 << (y & 7)
+        if color is None:
+            return int(bool(self._fb[index] & bit))
+        if color:
+            self._fb[index] |= bit
+        else:
+            self._fb[index] &= ~bit & 0xFF
+        return None
+
+    def fill_rect(self, x, y, width, height, color):
+        for xx in range(max(0, x), min(self.width, x + width)):
+            for yy in range(max(0, y), min(self.height, y + height)):
+                self.pixel(xx, yy, color)
+
+    def rect(self, x, y, width, height, color, *, fill=False):
+        if fill:
+            self.fill_rect(x, y, width, height, color)
+            return
+        self.hline(x, y, width, color)
+        self.hline(x, y + height - 1, width, color)
+        self.vline(x, y, height, color)
+        self.vline(x + width - 1, y, height, color)
+
+    def hline(self, x, y, width, color):
+        self.fill_rect(x, y, width, 1, color)
+
+    def vline(self, x, y, height, color):
+        self.fill_rect(x, y, 1, height, color)
+
+    def text(self, string, x, y, color, *, font_name="font5x8.bin", size=1):
+        for i, ch in enumerate(string):
+            for column in range(5):
+                bits = _glyph(ch, column)
+                for row in range(8):
+                    if bits >> row & 1:
+                        self.pixel(x + i * 6 + column, y + row, color)
+
+    def poweron(self):
+        pass
+
+    def poweroff(self):
+        pass
@@ -0,0 +1,194 @@
+# Virtual time stand-in for the CircuitPython asyncio subset used by the
+# firmware. Sleeping never waits for real, the loop jumps the virtual clock
+# to the next wake up, so runs are deterministic and fast.
+import heapq
+import sys
+from collections import deque
+
+import _hostsim as sim
+
+
+class CancelledError(BaseException):
+    pass
+
+
+class _Op:
+    __slots__ = ("kind", "arg")
+
+    def __init__(self, kind, arg=None):
+        self.kind = kind
+        self.arg = arg
+
+    def __await__(self):
+        return (yield self)
+
+
+class Task:
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.cancelled = False
+        self.result = None
+        self.exc = None
+        self.waiters = []
+        self.token = 0
+
+    def __await__(self):
+        if not self.done:
+            yield _Op("join", self)
+        if self.exc is not None:
+            raise self.exc
+        return self.result
+
+    def cancel(self):
+        if not self.done:
+            self.cancelled = True
+            _ready.append((self, None))
+
+
+_ready = deque()
+_sleeping = []
+_seq = 0
+
+
+def _finish(task, result, exc):
+    task.done = True
+    task.result = result
+    task.exc = exc
+    for waiter in task.waiters:
+        _ready.append((waiter, None))
+    if exc is not None and not task.waiters and not isinstance(exc, CancelledError):
+        raise exc
+
+
+def _step(task, value):
+    global _seq
+    if task.done:
+        return
+    task.token += 1
+    sim.advance(sim.TASK_SWITCH_NS)
+    try:
+        if task.cancelled:
+            task.cancelled = False
+            op = task.coro.throw(CancelledError())
+        else:
+            op = task.coro.send(value)
+    except StopIteration as e:
+        _finish(task, e.value, None)
+        return
+    except sim.SimulationEnd:
+        raise
+    except BaseException as e:
+        _finish(task, None, e)
+        return
+    if op.kind == "sleep":
+        _seq += 1
+        heapq.heappush(_sleeping, (sim.now_ns + op.arg, _seq, task.token, task))
+    elif op.kind == "join":
+        op.arg.waiters.append(task)
+    elif op.kind == "wait":
+        op.arg.append(task)
+    else:
+        _ready.append((task, None))
+
+
+def create_task(coro):
+    task = Task(coro)
+    _ready.append((task, None))
+    return task
+
+
+def sleep_ms(ms):
+    return _Op("sleep", max(0, int(ms)) * 1000000)
+
+
+def sleep(s):
+    return _Op("sleep", max(0, int(s * 1000000000)))
+
+
+async def gather(*aws, return_exceptions=False):
+    tasks = [a if isinstance(a, Task) else create_task(a) for a in aws]
+    results = []
+    for t in tasks:
+        try:
+            results.append(await t)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+class Lock:
+    def __init__(self):
+        self.state = False
+        self.waiting = deque()
+
+    def locked(self):
+        return self.state
+
+    async def acquire(self):
+        if self.state:
+            # Ownership is handed over by release()
+            await _Op("wait", self.waiting)
+        else:
+            self.state = True
+        return True
+
+    def release(self):
+        if self.waiting:
+            _ready.append((self.waiting.popleft(), None))
+        else:
+            self.state = False
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class Event:
+    def __init__(self):
+        self.state = False
+        self.waiting = []
+
+    def is_set(self):
+        return self.state
+
+    def set(self):
+        self.state = True
+        for task in self.waiting:
+            _ready.append((task, None))
+        del self.waiting[:]
+
+    def clear(self):
+        self.state = False
+
+    async def wait(self):
+        if not self.state:
+            await _Op("wait", self.waiting)
+        return True
+
+
+def run(coro):
+    sim.start(sys._getframe(1).f_globals)
+    _ready.clear()
+    del _sleeping[:]
+    main = create_task(coro)
+    while not main.done:
+        if _ready:
+            task, value = _ready.popleft()
+            _step(task, value)
+        elif _sleeping:
+            wake_ns, _, token, task = heapq.heappop(_sleeping)
+            if token != task.token:
+                # Woken early by cancel()
+                continue
+            sim.advance_to(wake_ns, busy=False)
+            _step(task, None)
+        else:
+            raise RuntimeError("all tasks are blocked")
+    if main.exc is not None:
+        raise main.exc
+    return main.result
@@ -0,0 +1,14 @@
+# Pin names of the Raspberry Pi Pico
+
+
+class Pin:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "board.{}".format(self.name)
+
+
+for _i in range(29):
+    globals()["GP{}".format(_i)] = Pin("GP{}".format(_i))
+LED = GP25
@@ -0,0 +1,83 @@
+# UART and I2C buses, writes are recorded with their time on the wire and
+# block the virtual clock the way the RP2040 peripherals do
+import _hostsim as sim
+
+_UART_FIFO = 32
+
+
+class UART:
+    def __init__(self, tx, rx, baudrate=9600, timeout=1, receiver_buffer_size=64):
+        self.baudrate = baudrate
+        self.byte_ns = 10 * 1000000000 // baudrate
+        self.wire_free_ns = 0
+        self.recorder = sim.recorder("uart") or sim.Recorder("uart")
+        self.recorder.byte_ns = self.byte_ns
+
+    def write(self, buf):
+        start = max(sim.now_ns, self.wire_free_ns)
+        self.wire_free_ns = start + len(buf) * self.byte_ns
+        self.recorder.record(start, buf)
+        # write() returns once the tail of buf fits into the TX FIFO
+        sim.advance_to(self.wire_free_ns - _UART_FIFO * self.byte_ns)
+        return len(buf)
+
+    def _available(self):
+        n = 0
+        for t, data in sim.uart_rx:
+            if t > sim.now_ms():
+                break
+            n += len(data)
+        return n
+
+    @property
+    def in_waiting(self):
+        return self._available()
+
+    def readinto(self, buf, nbytes=None):
+        n = min(len(buf) if nbytes is None else nbytes, self._available())
+        if n == 0:
+            return None
+        i = 0
+        while i < n:
+            t, data = sim.uart_rx[0]
+            take = min(n - i, len(data))
+            buf[i:i + take] = data[:take]
+            i += take
+            if take == len(data):
+                sim.uart_rx.pop(0)
+            else:
+                sim.uart_rx[0] = (t, data[take:])
+        return n
+
+    def read(self, nbytes=None):
+        buf = bytearray(nbytes or max(1, self._available()))
+        n = self.readinto(buf)
+        return None if n is None else bytes(buf[:n])
+
+    def reset_input_buffer(self):
+        del sim.uart_rx[:]
+
+
+class I2C:
+    def __init__(self, scl, sda, frequency=100000, timeout=255):
+        self.frequency = frequency
+        self.devices = dict()
+        self.recorder = sim.recorder("i2c") or sim.Recorder("i2c")
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def scan(self):
+        return list(self.devices)
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        data = bytes(buffer[start:end])
+        self.recorder.record(sim.now_ns, data)
+        # Address byte plus payload, 9 clocks per byte and a start/stop
+        sim.advance((len(data) + 2) * 9 * 1000000000 // self.frequency)
+        device = self.devices.get(address)
+        if device is not None:
+            device(data)
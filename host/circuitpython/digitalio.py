@@ -0,0 +1,33 @@
+# Digital pins, input values come from the pin scripts in _hostsim
+import _hostsim as sim
+
+
+class Direction:
+    INPUT = "INPUT"
+    OUTPUT = "OUTPUT"
+
+
+class Pull:
+    UP = "UP"
+    DOWN = "DOWN"
+
+
+class DigitalInOut:
+    def __init__(self, pin):
+        self.pin = pin
+        self.direction = Direction.INPUT
+        self.pull = None
+        self._value = False
+
+    @property
+    def value(self):
+        if self.direction == Direction.OUTPUT:
+            return self._value
+        return sim.pin_value(self.pin.name, self.pull == Pull.UP)
+
+    @value.setter
+    def value(self, v):
+        self._value = v
+
+    def deinit(self):
+        pass
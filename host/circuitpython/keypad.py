@@ -0,0 +1,94 @@
+# Key scanners, KeyMatrix replays sim.scripted_keys and Keys turns the pin
+# scripts into timestamped edge events
+import _hostsim as sim
+
+
+class Event:
+    def __init__(self, key_number=0, pressed=True, timestamp=None):
+        self.key_number = key_number
+        self.pressed = pressed
+        self.timestamp = sim.now_ms() if timestamp is None else timestamp
+
+    @property
+    def released(self):
+        return not self.pressed
+
+    def __repr__(self):
+        return "<Event: key_number {} {}>".format(self.key_number, "pressed" if self.pressed else "released")
+
+
+class EventQueue:
+    def __init__(self, source, max_events=64):
+        self._source = source
+        self._events = []
+        self._max_events = max_events
+        self.overflowed = False
+
+    def _fill(self):
+        for key_number, pressed, timestamp in self._source():
+            if len(self._events) >= self._max_events:
+                self.overflowed = True
+            else:
+                self._events.append((key_number, pressed, timestamp))
+
+    def get(self):
+        self._fill()
+        if not self._events:
+            return None
+        return Event(*self._events.pop(0))
+
+    def get_into(self, event):
+        self._fill()
+        if not self._events:
+            return False
+        event.key_number, event.pressed, event.timestamp = self._events.pop(0)
+        return True
+
+    def clear(self):
+        del self._events[:]
+        self.overflowed = False
+
+    def __len__(self):
+        self._fill()
+        return len(self._events)
+
+    def __bool__(self):
+        return len(self) > 0
+
+
+class KeyMatrix:
+    def __init__(self, row_pins, column_pins, columns_to_anodes=True, interval=0.02, max_events=64):
+        self.key_count = len(row_pins) * len(column_pins)
+        self.interval = interval
+        self.events = EventQueue(self._due, max_events)
+
+    def _due(self):
+        # A key change is seen at the first scan after it happened
+        scan_ms = max(1, int(self.interval * 1000))
+        while sim.scripted_keys:
+            t, key_number, pressed = sim.scripted_keys[0]
+            seen = t + (-t % scan_ms)
+            if seen > sim.now_ms():
+                break
+            sim.scripted_keys.pop(0)
+            yield key_number, pressed, seen
+
+
+class Keys:
+    def __init__(self, pins, *, value_when_pressed, pull=True, interval=0.02, max_events=64):
+        self.pins = pins
+        self.key_count = len(pins)
+        self.interval = interval
+        self.value_when_pressed = value_when_pressed
+        self._checked_ms = sim.now_ms()
+        self.events = EventQueue(self._due, max_events)
+
+    def _due(self):
+        until = sim.now_ms()
+        for key_number, pin in enumerate(self.pins):
+            for t, v in sim.pin_edges(pin.name, self._checked_ms, until):
+                yield key_number, v == self.value_when_pressed, t
+        self._checked_ms = until
+
+    def deinit(self):
+        pass
@@ -0,0 +1,18 @@
+# Only the parts used by the firmware: the 4 KB nvm sector and the CPU
+import _hostsim as sim
+
+
+class _NVM(bytearray):
+    def __setitem__(self, index, value):
+        # A write to the RP2040 nvm erases and programs the whole sector
+        sim.advance(sim.NVM_WRITE_NS)
+        bytearray.__setitem__(self, index, value)
+
+
+class _CPU:
+    frequency = 125000000
+    temperature = 27.0
+
+
+nvm = _NVM(sim.nvm_image or b"\xff" * 4096)
+cpu = _CPU()
@@ -0,0 +1,5 @@
+import _hostsim as sim
+
+
+def ticks_ms():
+    return sim.now_ms() & ((1 << 29) - 1)
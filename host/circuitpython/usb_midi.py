@@ -0,0 +1,36 @@
+# USB MIDI ports, writes are recorded and reads come from sim.usb_rx
+import _hostsim as sim
+
+
+class PortIn:
+    def readinto(self, buf, nbytes=None):
+        n = len(buf) if nbytes is None else nbytes
+        i = 0
+        while i < n and sim.usb_rx and sim.usb_rx[0][0] <= sim.now_ms():
+            t, data = sim.usb_rx[0]
+            take = min(n - i, len(data))
+            buf[i:i + take] = data[:take]
+            i += take
+            if take == len(data):
+                sim.usb_rx.pop(0)
+            else:
+                sim.usb_rx[0] = (t, data[take:])
+        return i
+
+    def read(self, nbytes):
+        buf = bytearray(nbytes)
+        n = self.readinto(buf)
+        return bytes(buf[:n])
+
+
+class PortOut:
+    def __init__(self):
+        self.recorder = sim.recorder("usb") or sim.Recorder("usb")
+
+    def write(self, buf):
+        self.recorder.record(sim.now_ns, buf)
+        sim.advance(sim.USB_WRITE_NS + len(buf) * sim.USB_BYTE_NS)
+        return len(buf)
+
+
+ports = (PortIn(), PortOut())
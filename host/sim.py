@@ -0,0 +1,133 @@
+"""Run the firmware under CPython against the stand-ins in host/circuitpython.
+
+    from host import sim
+    run = sim.run("src/main_v2.py", 10000, keys=[(500, 3, True), (560, 3, False)])
+    print(run.midi("usb"))
+
+Time is virtual: the firmware sees the clock move only when it sleeps or
+when a blocking hardware call is charged, so a run is deterministic and a
+minute of playback takes about a second of real time.
+"""
+import os
+import sys
+import types
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_STANDINS = os.path.join(_HERE, "circuitpython")
+if _STANDINS not in sys.path:
+    sys.path.insert(0, _STANDINS)
+
+import _hostsim  # noqa: E402
+
+_MODULES = [f[:-3] for f in os.listdir(_STANDINS) if f.endswith(".py")]
+_SWAPPED = ("time", "gc")
+
+
+class Run:
+    def __init__(self, namespace, duration_ms, error):
+        self.namespace = namespace
+        self.duration_ms = duration_ms
+        self.error = error
+        self.recorders = {r.name: r for r in _hostsim.recorders}
+        self.busy_ns = _hostsim.busy_ns
+        self.gc_collections = _hostsim.gc_collections
+        self.nvm = bytes(sys.modules["microcontroller"].nvm) if "microcontroller" in sys.modules else None
+
+    def writes(self, port):
+        r = self.recorders.get(port)
+        return [] if r is None else r.writes
+
+    def midi(self, port):
+        """Split the byte stream written to port into (time_ns, message) tuples,
+        expanding running status so every message carries its status byte.
+        On a serial port the time is when the last byte left the wire."""
+        r = self.recorders.get(port)
+        byte_ns = 0 if r is None else r.byte_ns
+        messages = []
+        status = 0
+        pending = []
+        for start, data in self.writes(port):
+            for i, b in enumerate(data):
+                t = start + (i + 1) * byte_ns
+                if b >= 0xF8:
+                    messages.append((t, bytes((b,))))
+                    continue
+                if b & 0x80:
+                    status = b
+                    pending = [b]
+                    if b >= 0xF0:
+                        status = 0
+                    continue
+                if not pending:
+                    pending = [status]
+                pending.append(b)
+                size = 2 if (pending[0] & 0xF0) in (0xC0, 0xD0) or pending[0] in (0xF1, 0xF3) else 3
+                if len(pending) == size:
+                    messages.append((t, bytes(pending)))
+                    pending = []
+        return messages
+
+
+def run(firmware, duration_ms, keys=(), pins=None, uart_rx=(), usb_rx=(), on_start=None, nvm=None):
+    """Execute firmware for duration_ms of virtual time.
+
+    keys are (time_ms, key_number, pressed) tuples for the KeyMatrix, pins maps
+    a pin name such as "GP22" to sorted (time_ms, value) tuples and uart_rx /
+    usb_rx are (time_ms, bytes) tuples fed to the MIDI inputs. on_start is
+    called with the firmware's globals when it enters its main loop and nvm
+    is the initial content of microcontroller.nvm, erased flash by default."""
+    for name in _MODULES:
+        if name != "_hostsim":
+            sys.modules.pop(name, None)
+    _hostsim.reset(duration_ms)
+    _hostsim.scripted_keys.extend(sorted(keys))
+    _hostsim.scripted_pins.update(pins or {})
+    _hostsim.uart_rx.extend(sorted(uart_rx))
+    _hostsim.usb_rx.extend(sorted(usb_rx))
+    _hostsim.on_start = on_start
+    _hostsim.nvm_image = nvm
+
+    with open(firmware) as f:
+        code = compile(f.read(), firmware, "exec")
+    module = types.ModuleType("__main__")
+    module.__file__ = firmware
+    # time and gc are built in, swap them instead of shadowing them on the path
+    real = dict((name, __import__(name)) for name in _SWAPPED)
+    for name in _SWAPPED:
+        sys.modules[name] = __import__("_" + name)
+    error = None
+    try:
+        exec(code, module.__dict__)
+    except _hostsim.SimulationEnd:
+        pass
+    except Exception as e:
+        error = e
+    finally:
+        sys.modules.update(real)
+    result = Run(module.__dict__, duration_ms, error)
+    if error is not None:
+        raise error
+    return result
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("firmware", nargs="?", default=os.path.join(_HERE, "..", "src", "main_v2.py"))
+    parser.add_argument("--ms", type=int, default=10000, help="virtual run time in ms")
+    args = parser.parse_args()
+
+    result = run(args.firmware, args.ms)
+    for port in ("uart", "usb"):
+        r = result.recorders.get(port)
+        if r is not None:
+            print("{}: {} messages, {} bytes in {} writes".format(
+                port, len(result.midi(port)), r.bytes, r.calls))
+    r = result.recorders.get("i2c")
+    if r is not None:
+        print("i2c: {} bytes in {} transfers".format(r.bytes, r.calls))
+
+
+if __name__ == "__main__":
+    main()
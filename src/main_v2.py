@@ -5,12 +5,26 @@ import digitalio
 import board
 import busio as io
 import time
+import gc
+import microcontroller
 import keypad
 import asyncio
-
-_ext_sync_pin = digitalio.DigitalInOut(board.GP22)
-_ext_sync_pin.direction = digitalio.Direction.INPUT
-_ext_sync_pin.pull = digitalio.Pull.UP
+from array import array
+from adafruit_ticks import ticks_ms, ticks_add, ticks_diff
+
+# External sync on GP22. keypad scans the pin in the background and queues
+# every falling edge with its timestamp, so the sequencer only checks the
+# queue and plays the step _SYNC_LATENCY_MS after the edge, whenever it
+# happened to look. Steps advance every _SYNC_PULSES_PER_STEP pulses, and
+# each of those plays _SYNC_STEPS_PER_PULSE steps spread over the measured
+# pulse interval.
+_SYNC_PULSES_PER_STEP = 1
+_SYNC_STEPS_PER_PULSE = 1
+_SYNC_LATENCY_MS = 4
+_sync_keys = keypad.Keys((board.GP22,), value_when_pressed=False,
+                         pull=True, interval=0.001)
+_sync_event = keypad.Event()
+_key_event = keypad.Event()
 
 t1b1 = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
 keymap = dict()
@@ -36,19 +50,31 @@ keymap[6] = 18
 keymap[5] = 19
 
 
-def midi2str(midi):
-    note = midi[0]
-    l = midi[2]
-    m = midi[3]
-    return "{} ({}) M{}".format(t1b1[note % 12] + str(int(note / 12) - 2), 2 ** l, m)
+def midi2str(note, l, m, chord=0):
+    # Note with the intervals of its chord from it, length and hits
+    text = t1b1[note % 12] + str(int(note / 12) - 2)
+    interval = 0
+    while chord:
+        interval += chord & 0x0F
+        chord >>= 4
+        text += "+{}".format(interval)
+    return "{} /{} x{}".format(text, 2 ** l, (m & 7) + 1)
 
 
-def nt(num):
-    return (num, 127, 0, 0)
+def timing2str(m, nudge):
+    # Gate when not the default, < or > for a ramp and the nudge in ticks
+    text = ""
+    gate = (m >> 3) & 7
+    if 0 < gate < len(_GATE_PERCENT):
+        text += " {}%".format(_GATE_PERCENT[gate])
+    text += ("", "<", ">", "")[m >> 6]
+    if nudge:
+        text += " {:+d}".format(nudge - ((nudge & 0x80) << 1))
+    return text
 
 
 def e1m1():
-    return [nt(28), nt(40), nt(52), nt(28), nt(40), nt(50), nt(28), nt(40), nt(48), nt(28), nt(40), nt(46), nt(28), nt(40), nt(47), nt(48)]
+    return (28, 40, 52, 28, 40, 50, 28, 40, 48, 28, 40, 46, 28, 40, 47, 48)
 
 
 def prepare_but(pin):
@@ -58,34 +84,26 @@ def prepare_but(pin):
     return lambda: p.value
 
 
-async def wait(ms):
-    await asyncio.sleep_ms(int(ms))
-
-
-async def wait_for_trigger(interval_ms=1):
-    global _ext_sync_pin, _step_mode
-    previous_value = _ext_sync_pin.value
-    while True:
-        current_value = _ext_sync_pin.value
-        if (not current_value and previous_value) or not _step_mode:
-            print("Ext trigger...")
-            break
-        await asyncio.sleep_ms(interval_ms)
-        previous_value = current_value
-
-
+# The matrix is scanned every _KEY_SCAN_INTERVAL seconds, which is also the
+# debounce time
+_KEY_SCAN_INTERVAL = 0.005
 keyboard = keypad.KeyMatrix(row_pins=(board.GP6, board.GP7, board.GP8, board.GP9), column_pins=(
-    board.GP10, board.GP11, board.GP12, board.GP13, board.GP14), columns_to_anodes=False, interval=0.02)
+    board.GP10, board.GP11, board.GP12, board.GP13, board.GP14), columns_to_anodes=False, interval=_KEY_SCAN_INTERVAL)
 
-i2c = io.I2C(board.GP21, board.GP20)
+_I2C_FREQUENCY = 400000
+i2c = io.I2C(board.GP21, board.GP20, frequency=_I2C_FREQUENCY)
 oled = adafruit_ssd1306.SSD1306_I2C(128, 64, i2c, addr=0x3C)
-uart_midi = io.UART(board.GP4, board.GP5, baudrate=32250)
+uart_midi = io.UART(board.GP4, board.GP5, baudrate=31250, timeout=0,
+                    receiver_buffer_size=256)
+usb_midi_in = usb_midi.ports[0]
 usb_midi_out = usb_midi.ports[1]
 
 oled.fill(0)
 oled.show()
 
 _tempo = 120
+# _step counts the steps of a bar of _steps steps, the tracks run at their
+# own lengths from _track_pos
 _steps = 16
 _step = 0
 _step_progress = 0
@@ -94,335 +112,1959 @@ _notes_per_beat = 2
 _track = 0
 _tracks = 4
 _octave = 5
+# Memory is allocated for _MAX_TRACKS tracks of _MAX_STEPS steps, _tracks of
+# them play, each with its own length, so tracks can run polymetric
+_MAX_TRACKS = 8
+_MAX_STEPS = 64
+_track_length = bytearray(b"\x10" * _MAX_TRACKS)
+_track_pos = bytearray(_MAX_TRACKS)
 
 _last_step_time = 0
+_step_deadline = 0
+_step_lateness = 0
+_max_step_lateness = 0
+_clock_resyncs = 0
+_clock_running = False
+_sync_pulses = 0
+_sync_last_pulse = None
+_sync_step_period = 0
+_sync_steps_left = 0
 _full_velocity = True
 _recording = False
 _step_mode = False
-_redraw = True
-
-_data = []
+# Bumped by every change to the settings above. The tasks run cooperatively
+# and never await halfway through an update, so reading the globals directly
+# is a consistent snapshot, the version only tells readers whether anything
+# changed since they last looked.
+_state_version = 0
+
+# Patterns are stored packed, one bytearray per track with _STEP_SIZE bytes
+# per step, so edits during playback write bytes in place instead of
+# allocating a new tuple. Fields are addressed by their _F_* offset.
+_F_NOTE = 0
+_F_VEL = 1
+_F_LEN = 2
+# Repeats within the step, gate and velocity ramp of the repeats packed as
+# hits - 1 | gate << 3 | ramp << 6, see the ratchet tables
+_F_MODE = 3
+_MODE_HITS = 0x07
+_MODE_GATE = 0x38
+_MODE_RAMP = 0xC0
+# Microtiming ticks, a signed byte
+_F_NUDGE = 4
+# Further notes of a chord, 2 bytes read as a little endian word: the
+# intervals stacked on the note, 1 to 15 semitones in 4 bits each from the
+# low bits on, 0 ends the chord. A step holds up to _CHORD_NOTES notes.
+_F_CHORD = 5
+_CHORD_NOTES = 4
+_STEP_SIZE = 7
+_NO_NOTE = 0xFF
+_EMPTY_STEP = bytes((_NO_NOTE, 0, 0, 0, 0, 0, 0))
+
+# Microtiming in ticks of 1 / _TICKS_PER_STEP step: every step can be nudged
+# by up to _NUDGE_MAX ticks either way and swing delays the odd steps by
+# _swing ticks, 4 of them give a triplet feel. _tick_ms[_TICKS_PER_STEP + k]
+# is k ticks in ms, the table is rebuilt when the tempo or steps per beat
+# change so that a step costs one lookup per track.
+_TICKS_PER_STEP = 12
+_NUDGE_MAX = _TICKS_PER_STEP // 2 - 1
+_SWING_MAX = _TICKS_PER_STEP // 2
+_swing = 0
+_tick_ms = array("l", [0] * (2 * _TICKS_PER_STEP + 1))
+_tick_tempo = 0
+_tick_npb = -1
+
+# There are _BANKS patterns, all of them stay in memory. _pattern is the
+# bank that is shown and edited (_bank), the sequencer reads the tracks of
+# _play. The bank that plays from the next bar on waits in _next_play and
+# the swap at the bar only exchanges the two references, so editing any
+# bank never touches what the sequencer reads in the middle of a step.
+# In song mode the banks follow the first _chain_length entries of _chain,
+# one bar each.
+_BANKS = 4
+_CHAIN_SIZE = 16
+_banks = []
 _channels = []
+# Bumped by every change to what the play grid shows: the playing bank and
+# its patterns, the track count or lengths. Edits of another bank leave it.
+_pattern_version = 0
 
-for i in range(_tracks):
-    _data.append([])
+for b in range(_BANKS):
+    _banks.append([bytearray(_EMPTY_STEP * _MAX_STEPS) for i in range(_MAX_TRACKS)])
+for i in range(_MAX_TRACKS):
     _channels.append(0)
-    for j in range(_steps):
-        _data[i].append((-1, 0, 0, 0))
-
-_data[0] = e1m1()
-print(_data)
+_bank = 0
+_pattern = _banks[0]
+_play_bank = 0
+_play = _pattern
+_next_bank = 0
+_next_play = _pattern
+_song = False
+_chain = bytearray(_CHAIN_SIZE)
+_chain_length = 0
+_chain_pos = 0
+
+
+def step_get(track, step, field):
+    return _pattern[track][step * _STEP_SIZE + field]
+
+
+def step_put(track, step, field, value):
+    global _pattern_version
+    _pattern[track][step * _STEP_SIZE + field] = value
+    _dirty_tracks[_bank] |= 1 << track
+    if _pattern is _play:
+        _pattern_version += 1
+
+
+def set_step(track, step, note, vel, length, mode):
+    global _pattern_version
+    _dirty_tracks[_bank] |= 1 << track
+    if _pattern is _play:
+        _pattern_version += 1
+    p = _pattern[track]
+    i = step * _STEP_SIZE
+    p[i + _F_NOTE] = note
+    p[i + _F_VEL] = vel
+    p[i + _F_LEN] = length
+    p[i + _F_MODE] = mode
+    p[i + _F_NUDGE] = 0
+    p[i + _F_CHORD] = 0
+    p[i + _F_CHORD + 1] = 0
+
+
+def step_chord(track, step):
+    i = step * _STEP_SIZE + _F_CHORD
+    return _pattern[track][i] | _pattern[track][i + 1] << 8
+
+
+def add_chord_note(track, step, note):
+    # Adds note to the chord of the step, which stays sorted. A note that
+    # is already there, one more than _CHORD_NOTES or one too far from its
+    # neighbours is left out. Works on the packed intervals alone, so
+    # recording an incoming chord allocates nothing.
+    root = step_get(track, step, _F_NOTE)
+    chord = step_chord(track, step)
+    if chord >> (4 * (_CHORD_NOTES - 2)):
+        return
+    if note < root:
+        if root - note > 0x0F:
+            return
+        chord = chord << 4 | (root - note)
+        root = note
+    else:
+        below = root
+        shift = 0
+        while True:
+            if note == below:
+                return
+            interval = (chord >> shift) & 0x0F
+            if not interval:
+                if note - below > 0x0F:
+                    return
+                chord |= (note - below) << shift
+                break
+            if note < below + interval:
+                # Split the interval around note
+                low = chord & ((1 << shift) - 1)
+                chord = (chord >> (shift + 4) << (shift + 8) | (below + interval - note) << (shift + 4)
+                         | (note - below) << shift | low)
+                break
+            below += interval
+            shift += 4
+    step_put(track, step, _F_NOTE, root)
+    step_put(track, step, _F_CHORD, chord & 0xFF)
+    step_put(track, step, _F_CHORD + 1, chord >> 8)
 
 
 def reset_track(t):
-    for j in range(_steps):
-        _data[t][j] = ((-1, 0, 0, 0))
+    global _pattern_version
+    _dirty_tracks[_bank] |= 1 << t
+    if _pattern is _play:
+        _pattern_version += 1
+    p = _pattern[t]
+    for i in range(0, len(p), _STEP_SIZE):
+        p[i:i + _STEP_SIZE] = _EMPTY_STEP
+
+
+# Patterns and settings are kept in microcontroller.nvm:
+#   0  b"PS", format version, _MAX_TRACKS, _MAX_STEPS, _STEP_SIZE
+#   6  tempo, steps per beat (_notes_per_beat), number of tracks
+#   9  MIDI channel of every track, then the length of every track
+#   9 + 2 * _MAX_TRACKS  number of banks saved, edited bank, chain length,
+#      swing, then the _CHAIN_SIZE chain entries
+#   _NVM_PATTERNS  the banks one after another, of every track only the
+#      steps up to its length
+# Banks that do not fit into the nvm are not saved. Every nvm write erases
+# and programs the whole flash sector and stalls the CPU for tens of ms, so
+# a save writes the span from the first to the last byte that changed in
+# one call, and only while playback is idle and nothing changed for
+# _SAVE_DELAY_MS. _nvm_image mirrors what was last loaded or saved, only
+# tracks marked in _dirty_tracks (a bit mask per bank) are copied into it
+# again, all of them when a track length moved them.
+_NVM_VERSION = 5
+_NVM_MAGIC = bytes((ord("P"), ord("S"), _NVM_VERSION, _MAX_TRACKS, _MAX_STEPS, _STEP_SIZE))
+_NVM_HEADER = 9
+_NVM_CHANNELS = _NVM_HEADER
+_NVM_LENGTHS = _NVM_HEADER + _MAX_TRACKS
+_NVM_BANKS = _NVM_LENGTHS + _MAX_TRACKS
+_NVM_CHAIN = _NVM_BANKS + 4
+_NVM_PATTERNS = _NVM_CHAIN + _CHAIN_SIZE
+_TRACK_BYTES = _MAX_STEPS * _STEP_SIZE
+_SAVE_DELAY_MS = 2000
+_nvm_image = bytearray(0 if microcontroller.nvm is None else min(
+    len(microcontroller.nvm), _NVM_PATTERNS + _BANKS * _MAX_TRACKS * _TRACK_BYTES))
+_dirty_tracks = [0] * _BANKS
+
+
+def load_state():
+    global _tempo, _notes_per_beat, _tracks, _bank, _chain_length, _swing
+    nvm = microcontroller.nvm
+    if nvm is None or len(nvm) < _NVM_PATTERNS or nvm[0:6] != _NVM_MAGIC:
+        return False
+    _nvm_image[:] = nvm[0:len(_nvm_image)]
+    if 1 <= nvm[6] <= 240:
+        _tempo = nvm[6]
+    if nvm[7] <= 4:
+        _notes_per_beat = nvm[7]
+    if 1 <= nvm[8] <= _MAX_TRACKS:
+        _tracks = nvm[8]
+    for t in range(_MAX_TRACKS):
+        _channels[t] = nvm[_NVM_CHANNELS + t] & 0x0F
+        if 1 <= nvm[_NVM_LENGTHS + t] <= _MAX_STEPS:
+            _track_length[t] = nvm[_NVM_LENGTHS + t]
+    if nvm[_NVM_BANKS + 1] < _BANKS:
+        _bank = nvm[_NVM_BANKS + 1]
+    _chain_length = min(nvm[_NVM_BANKS + 2], _CHAIN_SIZE)
+    if nvm[_NVM_BANKS + 3] <= _SWING_MAX:
+        _swing = nvm[_NVM_BANKS + 3]
+    for i in range(_chain_length):
+        _chain[i] = nvm[_NVM_CHAIN + i] % _BANKS
+    start = _NVM_PATTERNS
+    for b in range(min(nvm[_NVM_BANKS], _BANKS)):
+        for t in range(_MAX_TRACKS):
+            n = _track_length[t] * _STEP_SIZE
+            _banks[b][t][0:n] = _nvm_image[start:start + n]
+            start += n
+    return True
+
+
+def save_state():
+    nvm = microcontroller.nvm
+    if nvm is None:
+        return
+    image = _nvm_image
+    image[0:6] = _NVM_MAGIC
+    image[6] = _tempo
+    image[7] = _notes_per_beat
+    image[8] = _tracks
+    if image[_NVM_LENGTHS:_NVM_BANKS] != _track_length:
+        image[_NVM_LENGTHS:_NVM_BANKS] = _track_length
+        for b in range(_BANKS):
+            _dirty_tracks[b] = (1 << _MAX_TRACKS) - 1
+    for t in range(_MAX_TRACKS):
+        image[_NVM_CHANNELS + t] = _channels[t]
+    image[_NVM_BANKS + 1] = _bank
+    image[_NVM_BANKS + 2] = _chain_length
+    image[_NVM_BANKS + 3] = _swing
+    image[_NVM_CHAIN:_NVM_PATTERNS] = _chain
+    bank_bytes = sum(_track_length) * _STEP_SIZE
+    start = _NVM_PATTERNS
+    saved = 0
+    while saved < _BANKS and start + bank_bytes <= len(image):
+        tracks = _banks[saved]
+        for t in range(_MAX_TRACKS):
+            n = _track_length[t] * _STEP_SIZE
+            if _dirty_tracks[saved] & (1 << t):
+                image[start:start + n] = memoryview(tracks[t])[0:n]
+            start += n
+        _dirty_tracks[saved] = 0
+        saved += 1
+    image[_NVM_BANKS] = saved
+    lo = 0
+    hi = len(image)
+    while lo < hi and nvm[lo] == image[lo]:
+        lo += 1
+    while hi > lo and nvm[hi - 1] == image[hi - 1]:
+        hi -= 1
+    if lo < hi:
+        nvm[lo:hi] = image[lo:hi]
+
+
+if not load_state():
+    for j, n in enumerate(e1m1()):
+        set_step(0, j, n, 127, 0, 0)
+    # Nothing in nvm matches, the first save writes every track
+    for b in range(_BANKS):
+        _dirty_tracks[b] = (1 << _MAX_TRACKS) - 1
+_pattern = _play = _next_play = _banks[_bank]
+_play_bank = _next_bank = _bank
+
+
+# Outgoing MIDI, every port has its own queue so the slow DIN link never
+# holds up USB. USB writes do not block, its messages are packed into one
+# preallocated buffer and written with a single call when flushed. The UART
+# sends 3125 bytes per second, its messages wait in a ring packed as
+# status << 16 | data1 << 8 | data2 and are written only as far as the wire
+# catches up within _UART_AHEAD_US, so writes never block and a clock tick
+# never waits longer than that behind notes. uart_drain() sends the rest.
+# With running status the UART skips repeated status bytes and sends note
+# offs as zero velocity note ons, so a chord on one channel costs two bytes
+# per note. The slice tables avoid creating a memoryview on every write.
+_MIDI_OUT_SIZE = 63
+_UART_RUNNING_STATUS = True
+_UART_BYTE_US = 320
+_UART_AHEAD_US = 3000
+# When the ring is full a new note on is dropped. A note off cancels a note
+# on of the same note that is still queued, or else makes room by dropping
+# the oldest queued note on. Note offs are never dropped, but the note off
+# of a note on that was dropped is skipped, _uart_lost has a bit for every
+# such note laid out like _active. So the ring does not fill up with note
+# offs under overload and waiting for the wire is left for more than
+# _UART_QUEUE_SIZE notes sounding on the DIN port.
+_UART_QUEUE_SIZE = 64
+_uart_queue = array("l", [0] * _UART_QUEUE_SIZE)
+_uart_lost = bytearray(16 * 16)
+_uart_head = 0
+_uart_count = 0
+_uart_backlog_us = 0
+_uart_backlog_time = 0
+_uart_out = bytearray(_MIDI_OUT_SIZE)
+_uart_status = 0
+_uart_ready = asyncio.Event()
+_usb_out = bytearray(_MIDI_OUT_SIZE)
+_usb_out_len = 0
+_uart_out_slices = [memoryview(_uart_out)[:n] for n in range(_MIDI_OUT_SIZE + 1)]
+_usb_out_slices = [memoryview(_usb_out)[:n] for n in range(_MIDI_OUT_SIZE + 1)]
+# Bytes written per port, deepest UART queue, dropped and cancelled note ons
+_uart_bytes = 0
+_usb_bytes = 0
+_uart_max_depth = 0
+_uart_dropped = 0
+_uart_merged = 0
+
+
+def midi_length(status):
+    if status < 0xF0:
+        return 2 if status & 0xE0 == 0xC0 else 3
+    if status == 0xF2:
+        return 3
+    return 2 if status == 0xF1 or status == 0xF3 else 1
+
+
+def uart_room(now):
+    # Bytes that can be written now without blocking
+    global _uart_backlog_us, _uart_backlog_time
+    _uart_backlog_us -= ticks_diff(now, _uart_backlog_time) * 1000
+    if _uart_backlog_us < 0:
+        _uart_backlog_us = 0
+    _uart_backlog_time = now
+    return (_UART_AHEAD_US - _uart_backlog_us) // _UART_BYTE_US
+
+
+def uart_encode(msg, n):
+    # Appends msg to _uart_out at n and returns the new length
+    global _uart_status
+    status = msg >> 16
+    data1 = (msg >> 8) & 0x7F
+    data2 = msg & 0x7F
+    length = midi_length(status)
+    if status >= 0xF0:
+        # System common messages cancel running status, realtime ones do not
+        if status < 0xF8:
+            _uart_status = 0
+        _uart_out[n] = status
+        n += 1
+    elif _UART_RUNNING_STATUS:
+        if status & 0xF0 == 0x80:
+            status = 0x90 | (status & 0x0F)
+            data2 = 0
+        if status != _uart_status:
+            _uart_out[n] = status
+            _uart_status = status
+            n += 1
+    else:
+        _uart_out[n] = status
+        n += 1
+    if length > 1:
+        _uart_out[n] = data1
+        n += 1
+    if length > 2:
+        _uart_out[n] = data2
+        n += 1
+    return n
+
+
+def drain_uart(room):
+    # Writes queued messages up to room bytes in one call
+    global _uart_head, _uart_count, _uart_backlog_us, _uart_bytes
+    room = min(room, _MIDI_OUT_SIZE)
+    n = 0
+    while _uart_count:
+        msg = _uart_queue[_uart_head]
+        if n + midi_length(msg >> 16) > room:
+            break
+        n = uart_encode(msg, n)
+        _uart_head = (_uart_head + 1) & (_UART_QUEUE_SIZE - 1)
+        _uart_count -= 1
+    if n:
+        uart_midi.write(_uart_out_slices[n])
+        _uart_backlog_us += n * _UART_BYTE_US
+        _uart_bytes += n
+
+
+def _uart_remove(k):
+    global _uart_count
+    mask = _UART_QUEUE_SIZE - 1
+    for i in range(k, _uart_count - 1):
+        _uart_queue[(_uart_head + i) & mask] = _uart_queue[(_uart_head + i + 1) & mask]
+    _uart_count -= 1
+
+
+def _uart_lose(msg):
+    # Marks the note of a dropped note on, returns False for other messages
+    if msg >> 20 != 0x9 or not msg & 0x7F:
+        return False
+    note = (msg >> 8) & 0x7F
+    _uart_lost[(msg >> 12) & 0xF0 | note >> 3] |= 1 << (note & 7)
+    return True
+
+
+def uart_enqueue(msg):
+    global _uart_count, _uart_max_depth, _uart_dropped, _uart_merged
+    mask = _UART_QUEUE_SIZE - 1
+    kind = msg >> 16 & 0xF0
+    if kind == 0x80 or (kind == 0x90 and not msg & 0x7F):
+        i = (msg >> 12) & 0xF0 | (msg >> 11) & 0x0F
+        bit = 1 << ((msg >> 8) & 7)
+        if _uart_lost[i] & bit:
+            # Its note on never went out
+            _uart_lost[i] &= ~bit
+            return
+    if _uart_count == _UART_QUEUE_SIZE:
+        if _uart_lose(msg):
+            _uart_dropped += 1
+            return
+        oldest = -1
+        for k in range(_uart_count - 1, -1, -1):
+            queued = _uart_queue[(_uart_head + k) & mask]
+            if queued >> 20 == 0x9 and queued & 0x7F:
+                if kind == 0x80 and (queued ^ msg) & 0x0F7F00 == 0:
+                    # The note never started, neither message is needed
+                    _uart_remove(k)
+                    _uart_merged += 1
+                    return
+                oldest = k
+        if oldest >= 0:
+            _uart_lose(_uart_queue[(_uart_head + oldest) & mask])
+            _uart_remove(oldest)
+            _uart_dropped += 1
+        else:
+            # Nothing may be dropped, wait for the wire instead
+            drain_uart(midi_length(_uart_queue[_uart_head] >> 16))
+    _uart_queue[(_uart_head + _uart_count) & mask] = msg
+    _uart_count += 1
+    if _uart_count > _uart_max_depth:
+        _uart_max_depth = _uart_count
+
+
+def flush_midi():
+    global _usb_out_len, _usb_bytes
+    if _usb_out_len:
+        usb_midi_out.write(_usb_out_slices[_usb_out_len])
+        _usb_bytes += _usb_out_len
+        _usb_out_len = 0
+    if _uart_count:
+        drain_uart(uart_room(ticks_ms()))
+        if _uart_count:
+            _uart_ready.set()
+
+
+# Sounding notes, one bit per note and 16 bytes per channel, kept up to date
+# by every note on and off that is queued. _active_channels has a bit for
+# every channel that may have a note on, so a panic only looks at those.
+_active = bytearray(16 * 16)
+_active_channels = 0
+
+
+def queue_midi(status, data1, data2):
+    global _usb_out_len, _active_channels
+    kind = status & 0xF0
+    if kind == 0x90 and data2:
+        _active[(status & 0x0F) << 4 | data1 >> 3] |= 1 << (data1 & 7)
+        _active_channels |= 1 << (status & 0x0F)
+    elif kind == 0x80 or kind == 0x90:
+        _active[(status & 0x0F) << 4 | data1 >> 3] &= ~(1 << (data1 & 7))
+
+    length = midi_length(status)
+    if _usb_out_len + length > _MIDI_OUT_SIZE:
+        flush_midi()
+
+    n = _usb_out_len
+    _usb_out[n] = status
+    if length > 1:
+        _usb_out[n + 1] = data1
+    if length > 2:
+        _usb_out[n + 2] = data2
+    _usb_out_len = n + length
+
+    uart_enqueue(status << 16 | data1 << 8 | data2)
+
+
+async def uart_drain():
+    # Sends what flush_midi() could not write without blocking
+    while True:
+        await _uart_ready.wait()
+        _uart_ready.clear()
+        while _uart_count:
+            drain_uart(uart_room(ticks_ms()))
+            if _uart_count:
+                wait = _uart_backlog_us + 3 * _UART_BYTE_US - _UART_AHEAD_US
+                await asyncio.sleep_ms(wait // 1000 + 1)
+
+
+def send_note_on(note, vel, ch=0):
+    queue_midi(0x90 | ch, note, vel)
+    flush_midi()
+
+
+def send_note_off(note, ch=0):
+    queue_midi(0x80 | ch, note, 0)
+    flush_midi()
+
+
+# Pending note on/off messages, a binary heap ordered by due time. A message
+# is packed as status << 16 | note << 8 | velocity, so on equal times note
+# offs sort before note ons and a retriggered note is not cut short. The
+# intervals of a chord (see _F_CHORD) ride along in _event_chord, so a
+# chord takes one entry and its notes leave back to back in one burst.
+# Every track can have 8 hits of a step pending, a note on and off each,
+# and as many of the next step nudged ahead of it, so the heap never has to
+# send an event early.
+_EVENT_CAPACITY = 2 * 2 * 8 * _MAX_TRACKS
+_event_time = array("l", [0] * _EVENT_CAPACITY)
+_event_msg = array("l", [0] * _EVENT_CAPACITY)
+_event_chord = array("H", [0] * _EVENT_CAPACITY)
+_event_count = 0
+
+
+def _event_before(i, j):
+    d = ticks_diff(_event_time[i], _event_time[j])
+    return d < 0 or (d == 0 and _event_msg[i] < _event_msg[j])
+
+
+def _event_swap(i, j):
+    _event_time[i], _event_time[j] = _event_time[j], _event_time[i]
+    _event_msg[i], _event_msg[j] = _event_msg[j], _event_msg[i]
+    _event_chord[i], _event_chord[j] = _event_chord[j], _event_chord[i]
+
+
+def _queue_event(i):
+    msg = _event_msg[i]
+    status = msg >> 16
+    note = (msg >> 8) & 0x7F
+    vel = msg & 0x7F
+    queue_midi(status, note, vel)
+    chord = _event_chord[i]
+    while chord:
+        note += chord & 0x0F
+        chord >>= 4
+        queue_midi(status, note, vel)
+
+
+def pop_event():
+    # Queues the earliest event and removes it
+    global _event_count
+    _queue_event(0)
+    _event_count -= 1
+    _event_time[0] = _event_time[_event_count]
+    _event_msg[0] = _event_msg[_event_count]
+    _event_chord[0] = _event_chord[_event_count]
+    i = 0
+    while True:
+        child = 2 * i + 1
+        if child >= _event_count:
+            break
+        if child + 1 < _event_count and _event_before(child + 1, child):
+            child += 1
+        if not _event_before(child, i):
+            break
+        _event_swap(i, child)
+        i = child
 
 
-midilock = asyncio.Lock()
-datalock = asyncio.Lock()
+def _sift_up(i):
+    while i > 0:
+        parent = (i - 1) >> 1
+        if not _event_before(i, parent):
+            break
+        _event_swap(i, parent)
+        i = parent
+
+
+def schedule_event(t, msg, chord=0):
+    global _event_count
+    if _event_count == _EVENT_CAPACITY:
+        # Never drop a message, queue the earliest one ahead of time instead
+        pop_event()
+    i = _event_count
+    _event_time[i] = t
+    _event_msg[i] = msg
+    _event_chord[i] = chord
+    _event_count += 1
+    _sift_up(i)
+
+
+def advance_event(msg, chord, t, new_t):
+    # Moves msg due at t up to new_t, False when it is no longer pending
+    for i in range(_event_count):
+        if _event_msg[i] == msg and _event_chord[i] == chord and _event_time[i] == t:
+            _event_time[i] = new_t
+            _sift_up(i)
+            return True
+    return False
+
+
+def dispatch_events(now):
+    # Everything due in this tick leaves in one write per port
+    while _event_count and ticks_diff(_event_time[0], now) <= 0:
+        pop_event()
+    flush_midi()
+
+
+# MIDI clock output at 24 PPQN. The ticks are placed on the step grid: every
+# step of the internal clock starts 48 >> npb half ticks and the ticks that
+# fall inside it are spread over its length, so they share the notes'
+# deadlines and never drift from them. Realtime bytes are written straight
+# to both ports ahead of the note data flushed in the same pass. On the UART
+# a tick can still wait behind note bytes already handed to the driver, at
+# most _UART_AHEAD_US (3 ms) since the queue never hands it more.
+_MIDI_CLOCK_OUT = True
+_realtime = [bytearray((b,)) for b in range(0xF8, 0x100)]
+_clk_out_base = 0
+_clk_out_span = 0
+_clk_out_half_ticks = 0
+_clk_out_next = 0
+
+
+def send_realtime(status):
+    global _uart_backlog_us, _uart_bytes, _usb_bytes
+    # Realtime bytes may go between the bytes of other messages, so they skip
+    # the queues
+    buf = _realtime[status - 0xF8]
+    uart_room(ticks_ms())
+    uart_midi.write(buf)
+    _uart_backlog_us += _UART_BYTE_US
+    _uart_bytes += 1
+    usb_midi_out.write(buf)
+    _usb_bytes += 1
+
+
+def send_transport_start(step, notes_per_beat):
+    global _clk_out_half_ticks, _clk_out_next
+    _clk_out_half_ticks = 0
+    _clk_out_next = 0
+    if step == 0:
+        send_realtime(0xFA)
+        return
+    # Song position counts sixteenth notes, Continue is queued behind it so
+    # that it cannot overtake it on the UART
+    position = (step * 4) >> notes_per_beat
+    queue_midi(0xF2, position & 0x7F, (position >> 7) & 0x7F)
+    queue_midi(0xFB, 0, 0)
+    flush_midi()
+
+
+def send_transport_stop():
+    global _clk_out_half_ticks, _clk_out_next
+    _clk_out_half_ticks = 0
+    _clk_out_next = 0
+    send_realtime(0xFC)
+
+
+def clock_out_due():
+    # Time of the next clock tick, only valid while clock_out_pending()
+    return ticks_add(_clk_out_base, _clk_out_next * _clk_out_span // _clk_out_half_ticks)
+
+
+def clock_out_pending():
+    return _clk_out_next < _clk_out_half_ticks
+
+
+def dispatch_clock(now):
+    global _clk_out_next
+    while _clk_out_next < _clk_out_half_ticks and ticks_diff(clock_out_due(), now) <= 0:
+        send_realtime(0xF8)
+        _clk_out_next += 2
+
+
+def clock_out_step(deadline, period, half_ticks):
+    global _clk_out_base, _clk_out_span, _clk_out_half_ticks, _clk_out_next
+    # Ticks of the previous step that are still pending are late, send them
+    while _clk_out_next < _clk_out_half_ticks:
+        send_realtime(0xF8)
+        _clk_out_next += 2
+    _clk_out_next -= _clk_out_half_ticks
+    _clk_out_base = deadline
+    _clk_out_span = period
+    _clk_out_half_ticks = half_ticks
+
+
+# Last note on, its note off with its chord and when it is due per track
+_track_on = array("l", [0] * _MAX_TRACKS)
+_track_off = array("l", [0] * _MAX_TRACKS)
+_track_off_msg = array("l", [0] * _MAX_TRACKS)
+_track_off_chord = array("H", [0] * _MAX_TRACKS)
+# Whether the notes nudged ahead of the next step are scheduled
+_ahead = False
+
+
+# Ratchet tables in fractions of _FRAC_ONE of the note's duration, built
+# once at boot. A step's mode byte picks the rows: _hit_on[(hits - 1) << 3 | h]
+# is where hit h starts, the hits split the duration into equal slots that
+# end exactly with it. _mode_gate[mode & 0x3F] is the length of every hit,
+# _GATE_PERCENT of its slot where gate 0 means the whole duration for a
+# single note and 90 % for repeats. _hit_vel[mode >> 6 << 6 | (hits - 1) << 3 | h]
+# scales the velocity of hit h by 1/256: flat, rising from a quarter or
+# falling to a quarter. A hit then costs a multiply and a shift whatever the
+# tempo, clock source or number of hits.
+_FRAC_BITS = 12
+_FRAC_ONE = 1 << _FRAC_BITS
+_GATE_PERCENT = (90, 25, 50, 75, 100)
+_RAMPS = 3
+_hit_on = array("H", [0] * 64)
+_mode_gate = array("H", [0] * 64)
+_hit_vel = array("H", [256] * 256)
+
+for n in range(8):
+    for h in range(n + 1):
+        _hit_on[n << 3 | h] = h * _FRAC_ONE // (n + 1)
+        if n:
+            _hit_vel[64 | n << 3 | h] = 64 + 192 * h // n
+            _hit_vel[128 | n << 3 | h] = 256 - 192 * h // n
+    for g in range(8):
+        percent = _GATE_PERCENT[g] if g < len(_GATE_PERCENT) else _GATE_PERCENT[0]
+        if n == 0 and g == 0:
+            percent = 100
+        _mode_gate[g << 3 | n] = _FRAC_ONE * percent // (100 * (n + 1))
+
+
+def schedule_step(track, t, note, vel, duration, mode, chord=0):
+    ch = _channels[track]
+    on = (0x90 | ch) << 16 | note << 8
+    off = (0x80 | ch) << 16 | note << 8
+    _track_off_msg[track] = off
+    _track_off_chord[track] = chord
+    row = (mode & _MODE_HITS) << 3
+    ramp = (mode & _MODE_RAMP) | row
+    length = duration * _mode_gate[mode & 0x3F] >> _FRAC_BITS
+    if length < 1:
+        # A note off due with its note on would go first
+        length = 1
+    for h in range((mode & _MODE_HITS) + 1):
+        start = ticks_add(t, duration * _hit_on[row | h] >> _FRAC_BITS)
+        v = vel * _hit_vel[ramp | h] >> 8
+        schedule_event(start, on | (v if v else 1), chord)
+        end = ticks_add(start, length)
+        schedule_event(end, off, chord)
+    _track_on[track] = start
+    _track_off[track] = end
+
+
+def tick_table(tempo):
+    global _tick_tempo, _tick_npb
+    steps_per_minute = tempo << _notes_per_beat
+    d = steps_per_minute * _TICKS_PER_STEP
+    for k in range(-_TICKS_PER_STEP, _TICKS_PER_STEP + 1):
+        # k * 60000 / d rounded, integer math
+        _tick_ms[_TICKS_PER_STEP + k] = (120000 * k + d) // (2 * d)
+    _tick_tempo = tempo
+    _tick_npb = _notes_per_beat
+
+
+def chords_overlap(a, chord_a, b, chord_b):
+    # Whether the chords on the notes a and b have a note in common
+    while a != b:
+        if a < b:
+            if not chord_a:
+                return False
+            a += chord_a & 0x0F
+            chord_a >>= 4
+        else:
+            if not chord_b:
+                return False
+            b += chord_b & 0x0F
+            chord_b >>= 4
+    return True
+
+
+def schedule_tracks(deadline, period, early, late):
+    # Schedules the notes of the step due at deadline, with early those that
+    # are nudged ahead of it and with late the others. When the track still
+    # holds one of the notes its note off would cut the new one short, so the
+    # note off is moved up to the new note on, but never ahead of its own.
+    swing = _swing if _step & 1 else 0
+    for i in range(_tracks):
+        p = _play[i]
+        base = _track_pos[i] * _STEP_SIZE
+        note = p[base + _F_NOTE]
+        if note == _NO_NOTE:
+            continue
+        nudge = p[base + _F_NUDGE]
+        offset = _tick_ms[_TICKS_PER_STEP + swing + nudge - ((nudge & 0x80) << 1)]
+        if not (early if offset < 0 else late):
+            continue
+        t = ticks_add(deadline, offset)
+        chord = p[base + _F_CHORD] | p[base + _F_CHORD + 1] << 8
+        off = _track_off_msg[i]
+        if (off and ticks_diff(_track_off[i], t) > 0 and off >> 16 == 0x80 | _channels[i]
+                and chords_overlap((off >> 8) & 0x7F, _track_off_chord[i], note, chord)):
+            if ticks_diff(t, _track_on[i]) <= 0:
+                t = ticks_add(_track_on[i], 1)
+            advance_event(off, _track_off_chord[i], _track_off[i], t)
+        schedule_step(i, t, note, p[base + _F_VEL], period >> p[base + _F_LEN],
+                      p[base + _F_MODE], chord)
+
+
+def all_notes_off():
+    # Drops everything scheduled and ends the sounding notes in one write.
+    # A scheduled note off marks its note as sounding, another track may
+    # have ended the same note early.
+    global _event_count, _active_channels, _ahead
+    for i in range(_event_count):
+        msg = _event_msg[i]
+        if msg >> 20 == 0x8:
+            ch = (msg >> 16) & 0x0F
+            note = (msg >> 8) & 0x7F
+            chord = _event_chord[i]
+            _active_channels |= 1 << ch
+            while True:
+                _active[ch << 4 | note >> 3] |= 1 << (note & 7)
+                if not chord:
+                    break
+                note += chord & 0x0F
+                chord >>= 4
+    _event_count = 0
+    _ahead = False
+    for i in range(_MAX_TRACKS):
+        _track_off_msg[i] = 0
+    for ch in range(16):
+        if not _active_channels & (1 << ch):
+            continue
+        for i in range(ch << 4, (ch + 1) << 4):
+            bits = _active[i]
+            if bits:
+                for b in range(8):
+                    if bits & (1 << b):
+                        queue_midi(0x80 | ch, (i & 0x0F) << 3 | b, 0)
+    _active_channels = 0
+    flush_midi()
 
 
-def _send_note_on(note, vel, ch=0):
-    note_on_status = (0x90 | (ch))
-    msg = bytearray([note_on_status, note, vel])
-    uart_midi.write(msg)
-    usb_midi_out.write(msg)
+# Note and channel sent for each held piano key
+_held_note = bytearray(b"\xff" * 12)
+_held_channel = bytearray(12)
 
 
-def _send_note_off(note, ch=0):
-    note_off_status = (0x80 | (ch))
-    msg = bytearray([note_off_status, note, 0])
-    uart_midi.write(msg)
-    usb_midi_out.write(msg)
+def touch_state():
+    global _state_version
+    _state_version += 1
 
 
-async def send_note_on(note, vel, ch=0):
-    note_on_status = (0x90 | (ch))
-    msg = bytearray([note_on_status, note, vel])
-    async with midilock:
-        uart_midi.write(msg)
-        usb_midi_out.write(msg)
+def cue_bank(bank):
+    # bank plays from the next bar on
+    global _next_bank, _next_play
+    _next_bank = bank
+    _next_play = _banks[bank]
 
 
-async def send_note_off(note, ch=0):
-    note_off_status = (0x80 | (ch))
-    msg = bytearray([note_off_status, note, 0])
-    async with midilock:
-        uart_midi.write(msg)
-        usb_midi_out.write(msg)
+def swap_bank():
+    global _play, _play_bank, _pattern_version
+    _play = _next_play
+    _play_bank = _next_bank
+    _pattern_version += 1
 
 
-async def send_note(note, vel, duration, ch=0):
-    await send_note_on(note, vel, ch)
-    await asyncio.sleep_ms(duration)
-    await send_note_off(note, ch)
+def next_step():
+    global _step, _chain_pos
+    _step += 1
+    if _step >= _steps:
+        _step -= _steps
+    # A new bank starts all tracks from their first step
+    swap = _step == 0 and _next_play is not _play
+    for i in range(_tracks):
+        pos = _track_pos[i] + 1
+        _track_pos[i] = 0 if swap or pos >= _track_length[i] else pos
+    if swap:
+        swap_bank()
+    if _step == 0 and _song:
+        # The bank swapped in above was cued a bar ago, the one for the
+        # following bar is cued right away
+        pos = _chain_pos + 1
+        _chain_pos = pos if pos < _chain_length else 0
+        pos = _chain_pos + 1
+        cue_bank(_chain[pos if pos < _chain_length else 0])
+        touch_state()
+    elif swap:
+        touch_state()
+
+
+def rewind():
+    global _step, _chain_pos
+    _step = 0
+    for i in range(_MAX_TRACKS):
+        _track_pos[i] = 0
+    if _song:
+        _chain_pos = 0
+        cue_bank(_chain[0])
+        swap_bank()
+        cue_bank(_chain[1 % _chain_length])
+    elif _next_play is not _play:
+        swap_bank()
+
+
+# Timing histograms, off by default and started, cleared and stopped with
+# modifier 2 + key 3. Bucket b counts values from 2 ** (b - 1) up to
+# 2 ** b - 1, bucket 0 counts zeros and the last bucket has no upper bound.
+# While off every probe costs one global lookup.
+_HIST_BUCKETS = 12
+_HIST_LATE = 0
+_HIST_PASS = 1
+_HIST_SHOW = 2
+_HIST_WAIT = 3
+_HIST_KEY = 4
+_HIST_GC = 5
+# Step lateness, sequencer loop pass, display span transfer, display held
+# back for the sequencer, key press to note on, scheduled garbage collection
+_HIST_NAMES = ("late ms", "pass us", "show us", "wait ms", "key ms ", "gc ms  ")
+_hist = array("L", [0] * (len(_HIST_NAMES) * _HIST_BUCKETS))
+_profiling = False
+
+
+def hist_add(hist, value):
+    b = 0
+    while value > 0 and b < _HIST_BUCKETS - 1:
+        value >>= 1
+        b += 1
+    _hist[hist * _HIST_BUCKETS + b] += 1
+
+
+def hist_since(hist, started):
+    hist_add(hist, (time.monotonic_ns() - started) // 1000)
+
+
+def hist_clear():
+    for i in range(len(_hist)):
+        _hist[i] = 0
+
+
+def hist_print():
+    print("hist  " + " ".join("{:>5}".format(1 << b >> 1) for b in range(_HIST_BUCKETS)))
+    for h in range(len(_HIST_NAMES)):
+        base = h * _HIST_BUCKETS
+        print(_HIST_NAMES[h] + " " + " ".join(
+            "{:>5}".format(_hist[base + b]) for b in range(_HIST_BUCKETS)))
+    print("gc: {} bytes allocated between the last two, last {} ms, max {} ms".format(
+        _gc_alloc, _gc_ms, _gc_max_ms))
+    print("midi out: uart {} bytes, queue {} max {}, {} dropped {} cancelled, usb {} bytes".format(
+        _uart_bytes, _uart_count, _uart_max_depth, _uart_dropped, _uart_merged, _usb_bytes))
+    print("steps: late {} ms, max {} ms, {} resyncs".format(
+        _step_lateness, _max_step_lateness, _clock_resyncs))
+    print("keys: key to note {} ms, max {} ms".format(_key_latency, _max_key_latency))
+    print("midi clock: locked in {} ms, phase error {} us, jitter {} us".format(
+        _clock_lock_ms, _clock_phase_error * 1000 >> 8, _clock_jitter * 1000 >> 8))
+
+
+# Playback allocates nothing per step, so garbage collection is run at known
+# points instead of whenever the heap runs out: once per bar as soon as the
+# sequencer has _GC_GAP_MS to spare, and every _GC_IDLE_MS while the
+# internal clock is stopped. Automatic collection stays enabled as a fallback.
+_GC_GAP_MS = 8
+_GC_IDLE_MS = 1000
+_gc_pending = False
+_gc_last = 0
+_gc_live = 0
+_gc_alloc = 0
+_gc_ms = 0
+_gc_max_ms = 0
+
+
+def collect_garbage(now):
+    global _gc_pending, _gc_last, _gc_live, _gc_alloc, _gc_ms, _gc_max_ms
+    # Bytes allocated since the previous collection, one bar in playback
+    _gc_alloc = gc.mem_alloc() - _gc_live
+    gc.collect()
+    _gc_last = ticks_ms()
+    _gc_live = gc.mem_alloc()
+    _gc_ms = ticks_diff(_gc_last, now)
+    if _gc_ms > _gc_max_ms:
+        _gc_max_ms = _gc_ms
+    if _profiling:
+        hist_add(_HIST_GC, _gc_ms)
+    _gc_pending = False
+
+
+# Text fields of the screens as (x, y, width in characters). A field is only
+# redrawn when its text changes, and only the columns of the 8 pixel pages it
+# touches are sent to the display.
+_FIELDS = ((0, 0, 16), (100, 0, 3), (0, 10, 16), (100, 10, 2),
+           (0, 20, 21), (0, 30, 21), (0, 40, 21), (0, 50, 21))
+_FLD_BPM = 0
+_FLD_MODE = 1
+_FLD_OCT = 2
+_FLD_ST = 3
+_FLD_STEP = 4
+_FLD_TRACK = 5
+_FLD_NOTE = 6
+_FLD_LAT = 7
+_field_text = [""] * len(_FIELDS)
+
+_SET_COL_ADDR = 0x21
+_SET_PAGE_ADDR = 0x22
+_PAGES = 8
+_dirty_lo = bytearray(b"\xff" * _PAGES)
+_dirty_hi = bytearray(_PAGES)
+_display_cmd = bytearray((0x00, _SET_COL_ADDR, 0, 0, _SET_PAGE_ADDR, 0, 0))
+# Dirty spans are sent in chunks of at most _DISPLAY_CHUNK columns, and a
+# chunk is held back when it would delay the sequencer by more than
+# _DISPLAY_JITTER_MS, but never longer than _DISPLAY_MAX_WAIT_MS so that a
+# busy sequencer cannot freeze the display
+_DISPLAY_CHUNK = 32
+_DISPLAY_JITTER_MS = 1
+_DISPLAY_MAX_WAIT_MS = 100
+
+
+def mark_dirty(x, y, width, height):
+    for page in range(y >> 3, ((y + height - 1) >> 3) + 1):
+        if x < _dirty_lo[page]:
+            _dirty_lo[page] = x
+        if x + width - 1 > _dirty_hi[page]:
+            _dirty_hi[page] = x + width - 1
+
+
+def draw_field(field, text):
+    if _field_text[field] == text:
+        return
+    _field_text[field] = text
+    x, y, width = _FIELDS[field]
+    oled.fill_rect(x, y, width * 6, 8, 0)
+    oled.text(text, x, y, 1)
+    mark_dirty(x, y, width * 6, 8)
+
+
+def clear_fields():
+    for field in range(len(_FIELDS)):
+        draw_field(field, "")
+
+
+def show_span(page, lo, hi):
+    _display_cmd[2] = lo
+    _display_cmd[3] = hi
+    _display_cmd[5] = page
+    _display_cmd[6] = page
+    # The framebuffer follows a 0x40 data prefix, borrow the byte in front
+    # of the span for the prefix so the span is sent without a copy
+    buf = oled.buffer
+    start = page * oled.width + lo
+    saved = buf[start]
+    buf[start] = 0x40
+    with oled.i2c_device as device:
+        device.write(_display_cmd)
+        device.write(buf, start=start, end=start + hi - lo + 2)
+    buf[start] = saved
+
+
+async def display_slot(columns):
+    # Transfer time of the chunk in ms, 9 clocks per byte plus the command
+    cost = (columns + len(_display_cmd) + 4) * 9000 // _I2C_FREQUENCY + 1
+    asked = ticks_ms()
+    while True:
+        await asyncio.sleep_ms(0)
+        now = ticks_ms()
+        free = sequencer_free_ms(now)
+        if free + _DISPLAY_JITTER_MS >= cost or ticks_diff(now, asked) >= _DISPLAY_MAX_WAIT_MS:
+            if _profiling:
+                hist_add(_HIST_WAIT, ticks_diff(now, asked))
+            return
+        # Let the sequencer handle its deadline first
+        await asyncio.sleep_ms(free + 1)
+
+
+_show_page = 0
+
+
+async def show_dirty(budget=0xFFFF):
+    # Sends dirty spans until about budget bytes went over the bus, what does
+    # not fit stays dirty and goes first next time. Returns the unused budget.
+    global _show_page
+    first = _show_page
+    for i in range(_PAGES):
+        page = (first + i) % _PAGES
+        lo = _dirty_lo[page]
+        hi = _dirty_hi[page]
+        if lo > hi:
+            continue
+        _dirty_lo[page] = 0xFF
+        _dirty_hi[page] = 0
+        while lo <= hi:
+            end = min(hi, lo + _DISPLAY_CHUNK - 1)
+            cost = end - lo + 1 + len(_display_cmd) + 4
+            if cost > budget:
+                mark_dirty(lo, page << 3, hi - lo + 1, 8)
+                _show_page = page
+                return 0
+            budget -= cost
+            await display_slot(end - lo + 1)
+            started = time.monotonic_ns() if _profiling else 0
+            show_span(page, lo, end)
+            if started:
+                hist_since(_HIST_SHOW, started)
+            lo = end + 1
+    return budget
+
+
+# Play mode grid below page _GRID_PAGE, one row per playing track and one
+# cell per step. A row takes a page, or half of one with more than five
+# tracks. A note is a block, an empty step a dot on the row's baseline and
+# the step that played last is inverted. Cells are written straight into
+# their framebuffer bytes. When the playhead moves only the cells it leaves
+# and enters are redrawn, and at most _GRID_BYTES_PER_STEP bytes go to the
+# display per step, anything left over follows with the next steps. The
+# budget fits a playhead move of 8 pixel cells on each of eight tracks.
+_GRID_PAGE = 3
+_GRID_BYTES_PER_STEP = 240
+_grid_head = bytearray(_MAX_TRACKS)
+_grid_width = 8
+_grid_rows = 1
+
+
+def grid_cell(t, s, head):
+    height = 8 // _grid_rows
+    shift = (t % _grid_rows) * height
+    cell = ((1 << (height - 1)) - 1) << shift
+    if s >= _track_length[t]:
+        bits = 0
+    elif _play[t][s * _STEP_SIZE + _F_NOTE] != _NO_NOTE:
+        bits = cell
+    else:
+        bits = 1 << (shift + height - 2)
+    if head:
+        bits ^= cell
+    page = _GRID_PAGE + t // _grid_rows
+    x = s * _grid_width
+    buf = oled.buffer
+    i = page * oled.width + x + 1
+    for c in range(i, i + _grid_width - 1):
+        buf[c] = (buf[c] & ~cell) | bits
+    mark_dirty(x, page << 3, _grid_width - 1, 8)
+
+
+def grid_head(t):
+    # _track_pos is the step that plays next
+    pos = _track_pos[t]
+    return (pos if pos else _track_length[t]) - 1
+
+
+def clear_grid():
+    buf = oled.buffer
+    for i in range(_GRID_PAGE * oled.width + 1, len(buf)):
+        buf[i] = 0
+    mark_dirty(0, _GRID_PAGE << 3, oled.width, oled.height - (_GRID_PAGE << 3))
+
+
+async def draw_grid():
+    global _grid_width, _grid_rows
+    _grid_rows = 1 if _tracks <= _PAGES - _GRID_PAGE else 2
+    longest = 1
+    for t in range(_tracks):
+        longest = max(longest, _track_length[t])
+    _grid_width = min(8, max(2, oled.width // longest))
+    clear_grid()
+    for t in range(_tracks):
+        # A row takes a few ms of framebuffer writes, let the sequencer in
+        # between them
+        await asyncio.sleep_ms(0)
+        head = grid_head(t)
+        _grid_head[t] = head
+        for s in range(_track_length[t]):
+            grid_cell(t, s, s == head)
+
+
+async def move_playheads(budget):
+    # Sent track by track, a dirty span per page would otherwise stretch
+    # between the playheads of tracks of different lengths
+    for t in range(_tracks):
+        head = grid_head(t)
+        old = _grid_head[t]
+        if head != old:
+            grid_cell(t, old, False)
+            if head != old + 1:
+                # Wrapped around, the cells are a row apart
+                budget = await show_dirty(budget)
+            grid_cell(t, head, True)
+            _grid_head[t] = head
+            budget = await show_dirty(budget)
+    return budget
 
 
-async def send_note_triplet(note, vel, duration, ch=0):
-    await send_note_on(note, vel, ch)
-    await asyncio.sleep_ms(int(duration / 3 * 0.9))
-    await send_note_off(note, ch)
-    await asyncio.sleep_ms(int(duration * 0.1))
-    await send_note_on(note, vel, ch)
-    await asyncio.sleep_ms(int(duration / 3 * 0.9))
-    await send_note_off(note, ch)
-    await asyncio.sleep_ms(int(duration * 0.1))
-    await send_note_on(note, vel, ch)
-    await asyncio.sleep_ms(int(duration / 3 * 0.9))
-    await send_note_off(note, ch)
-    await asyncio.sleep_ms(int(duration * 0.1))
+async def update_display():
+    shown_recording = None
+    shown_version = -1
+    shown_pattern = -1
+    shown_step = -1
+    shown_lateness = -1
+    budget = 0
+    while True:
+        if _recording != shown_recording:
+            clear_fields()
+            clear_grid()
+            shown_recording = _recording
+            shown_version = -1
+            shown_pattern = -1
+        if not _recording:
+            # Play mode follows the playhead with a byte budget per step,
+            # without steps to pace it the budget is refilled every pass
+            if _step != shown_step:
+                shown_step = _step
+                budget = _GRID_BYTES_PER_STEP
+                if _pattern_version == shown_pattern:
+                    budget = await move_playheads(budget)
+            elif not (_clock_running or _sync_steps_left):
+                budget = _GRID_BYTES_PER_STEP
+            if _pattern_version != shown_pattern:
+                # Only the framebuffer is redrawn here, it reaches the
+                # display within the budget over the next steps
+                shown_pattern = _pattern_version
+                await draw_grid()
+            if _state_version == shown_version:
+                if budget:
+                    budget = await show_dirty(budget)
+                await asyncio.sleep_ms(10)
+                continue
+        elif _state_version == shown_version and _step == shown_step and (
+                _max_step_lateness == shown_lateness):
+            await asyncio.sleep_ms(100)
+            continue
+        shown_version = _state_version
+        shown_step = _step
+        shown_lateness = _max_step_lateness
+
+        tempo = _tempo if _midi_transport == _TRANSPORT_OFF else _clock_tempo
+        if _swing:
+            # Tempo / steps per beat, so that it fits with the swing
+            draw_field(_FLD_BPM, "BPM:{}/{} SW:{}".format(
+                tempo, 2 ** _notes_per_beat, _swing))
+        else:
+            draw_field(_FLD_BPM, "BPM: {} NPB: {}".format(
+                tempo, 2 ** _notes_per_beat))
+        draw_field(_FLD_ST, "ST" if _step_mode else "")
+        if _recording:
+            draw_field(_FLD_MODE, "REC")
+            draw_field(_FLD_OCT, "OCT: {}".format(_octave))
+            pos = _track_pos[_track]
+            draw_field(_FLD_STEP, "STP:{}/{} B{}{}".format(
+                pos + 1, _track_length[_track], _bank + 1, timing2str(
+                    step_get(_track, pos, _F_MODE), step_get(_track, pos, _F_NUDGE))))
+            draw_field(_FLD_TRACK, "TRK: {}/{} (CH{})".format(
+                _track + 1, _tracks, _channels[_track] + 1))
+            note = step_get(_track, pos, _F_NOTE)
+            if note == _NO_NOTE:
+                draw_field(_FLD_NOTE, "-")
+            else:
+                draw_field(_FLD_NOTE, midi2str(note, step_get(_track, pos, _F_LEN), step_get(
+                    _track, pos, _F_MODE), step_chord(_track, pos)))
+            draw_field(_FLD_LAT, "LAT: {}/{}ms R{}".format(
+                _step_lateness, _max_step_lateness, _clock_resyncs))
+        else:
+            if _midi_transport == _TRANSPORT_OFF:
+                draw_field(_FLD_MODE, "PLA")
+                if _song:
+                    draw_field(_FLD_OCT, "SNG: {}/{} B{}".format(
+                        _chain_pos + 1, _chain_length, _play_bank + 1))
+                else:
+                    text = "BNK: {}".format(_play_bank + 1)
+                    if _next_bank != _play_bank:
+                        text += ">{}".format(_next_bank + 1)
+                    if _chain_length:
+                        text += " CHN: {}".format(_chain_length)
+                    draw_field(_FLD_OCT, text)
+            else:
+                draw_field(_FLD_MODE, "EXT")
+                if _clock_lock_ms < 0:
+                    draw_field(_FLD_OCT, "SYN: -")
+                else:
+                    # Lock time in s and phase error, at most 16 characters
+                    lock = min(_clock_lock_ms, 99999)
+                    draw_field(_FLD_OCT, "SYN:{}.{}s {}us".format(
+                        lock // 1000, lock % 1000 // 100, min(abs(_clock_phase_error) * 1000 >> 8, 9999)))
+            budget = await show_dirty(budget)
+            await asyncio.sleep_ms(10)
+            continue
+        await show_dirty()
+        await asyncio.sleep_ms(100)
 
 
-async def send_note_doublet(note, vel, duration, ch=0):
-    await send_note_on(note, vel, ch)
-    await asyncio.sleep_ms(int(duration / 2 * 0.9))
-    await send_note_off(note, ch)
-    await asyncio.sleep_ms(int(duration * 0.1))
-    await send_note_on(note, vel, ch)
-    await asyncio.sleep_ms(int(duration / 2 * 0.9))
-    await send_note_off(note, ch)
+# Function key actions, looked up in _KEY_ACTIONS[recording][modifier][key - 12]
+# where modifier is 0 without modifier, 1 for modifier 1, 2 for modifier 2
+# and 3 for both. Keys 16 and 17 are the modifiers.
+def key_record():
+    global _recording, _step_mode
+    if not _step_mode:
+        _recording = not _recording
+        release_midi_clock()
+    else:
+        _step_mode = False
 
 
-async def all_notes_off():
-    tasks = []
-    for i in range(_tracks):
-        for j in range(_steps):
-            if not _data[i][j][0] == -1:
-                tasks.append(send_note_off(_data[i][j][0], _channels[i]))
-    await asyncio.gather(*tasks)
+def key_step():
+    global _step_mode
+    if not _step_mode:
+        _step_mode = True
+    else:
+        next_step()
 
 
-async def get_display_data():
-    async with datalock:
-        return (_tempo, _octave, _step, _steps, _track, _tracks, _recording, _step_mode, _channels[_track], _data[_track][_step], _notes_per_beat, _redraw)
+def key_reset_track():
+    reset_track(_track)
 
 
-async def get_application_data():
-    async with datalock:
-        return (_tempo, _octave, _step, _steps, _track, _tracks, _recording, _step_mode, _channels[_track], _notes_per_beat)
+def key_steps_per_beat():
+    global _notes_per_beat
+    _notes_per_beat = (_notes_per_beat + 1) % 5
 
 
-async def update_application_data(tempo, octave, recording, step_mode, track, channel, notes_per_beat):
-    global _tempo, _octave, _step_mode, _track, _recording, _channels, _notes_per_beat
-    async with datalock:
-        _tempo = tempo
-        _octave = octave
-        _step_mode = step_mode
-        _track = track
-        _channels[track] = channel
-        _notes_per_beat = notes_per_beat
-        _recording = recording
+def key_profiling():
+    global _profiling
+    _profiling = not _profiling
+    if _profiling:
+        hist_clear()
 
 
-async def get_step_data(track, step):
-    global _data
-    async with datalock:
-        return _data[track][step]
+def key_length():
+    pos = _track_pos[_track]
+    step_put(_track, pos, _F_LEN, (step_get(_track, pos, _F_LEN) + 1) % 5)
 
 
-async def set_step_data(track, step, step_data):
-    global _data
-    async with datalock:
-        _data[track][step] = step_data
+def key_note_mode():
+    # One to eight hits
+    pos = _track_pos[_track]
+    mode = step_get(_track, pos, _F_MODE)
+    step_put(_track, pos, _F_MODE, mode & ~_MODE_HITS | (mode + 1) & _MODE_HITS)
 
 
-async def next_step():
-    global _step, _steps
-    async with datalock:
-        _step += 1
-        if _step >= _steps:
-            _step -= _steps
+def key_gate():
+    pos = _track_pos[_track]
+    mode = step_get(_track, pos, _F_MODE)
+    gate = ((mode & _MODE_GATE) >> 3) + 1
+    if gate >= len(_GATE_PERCENT):
+        gate = 0
+    step_put(_track, pos, _F_MODE, mode & ~_MODE_GATE | gate << 3)
 
 
-async def update_display():
-    global _redraw
-    while True:
-        tempo, octave, step, steps, track, tracks, recording, step_mode, current_channel, step_data, notes_per_beat, redraw = await get_display_data()
-        if recording:
-            oled.fill(0)
-            oled.text("BPM: {} NPB: {}".format(
-                tempo, 2 ** notes_per_beat), 0, 0, 1)
-            oled.text("OCT: {}".format(octave), 0, 10, 1)
-            oled.text("STP: {}/{}".format(step + 1, steps), 0, 20, 1)
-            oled.text("TRK: {}/{} (CH{})".format(track + 1,
-                                                 tracks, current_channel + 1), 0, 30, 1)
-            if step_data[0] == -1:
-                oled.text("Note: -", 0, 40, 1)
-            else:
-                oled.text("Note: {}".format(midi2str(step_data)), 0, 40, 1)
-            if recording:
-                oled.text("REC", 100, 0, 1)
-            if step_mode:
-                oled.text("ST", 100, 10, 1)
-            oled.show()
-            await asyncio.sleep_ms(100)
-        elif redraw:
-            oled.fill(0)
-            oled.text("BPM: {} NPB: {}".format(
-                tempo, 2 ** notes_per_beat), 0, 0, 1)
-            oled.text("PLA", 100, 0, 1)
-            if step_mode:
-                oled.text("ST", 100, 10, 1)
-            oled.show()
-            _redraw = False
-            await asyncio.sleep_ms(100)
-        else:
-            await asyncio.sleep_ms(100)
+def key_ramp():
+    pos = _track_pos[_track]
+    mode = step_get(_track, pos, _F_MODE)
+    ramp = ((mode >> 6) + 1) % _RAMPS
+    step_put(_track, pos, _F_MODE, mode & ~_MODE_RAMP | ramp << 6)
 
 
-async def handle_input():
-    modifier1_pressed = False
-    modifier2_pressed = False
-    global _redraw
-    while True:
-        tempo, octave, step, steps, track, tracks, recording, step_mode, current_channel, notes_per_beat = await get_application_data()
-        while True:
-            e = keyboard.events.get()
-            if e == None:
-                break
+def key_nudge():
+    # Cycles through -_NUDGE_MAX.._NUDGE_MAX ticks
+    pos = _track_pos[_track]
+    nudge = step_get(_track, pos, _F_NUDGE)
+    nudge = nudge - ((nudge & 0x80) << 1) + 1
+    if nudge > _NUDGE_MAX:
+        nudge = -_NUDGE_MAX
+    step_put(_track, pos, _F_NUDGE, nudge & 0xFF)
 
-            key = keymap[e.key_number]
 
-            if key < 12:
-                if e.pressed:
-                    await send_note_on(key + octave * 12, 127)
+def key_swing():
+    global _swing
+    _swing = (_swing + 1) % (_SWING_MAX + 1)
 
-                    if recording:
-                        await set_step_data(track, step, (key + octave * 12, 127, 0, 0))
-                else:
-                    await send_note_off(key + octave * 12)
-                    pass
-
-            elif e.pressed:
-                if not recording:
-                    _redraw = True
-
-                if key == 12:
-                    if modifier1_pressed:
-                        reset_track(track)
-                    else:
-                        if not step_mode:
-                            recording = not recording
-                        else:
-                            step_mode = False
-                elif key == 13:
-                    if not step_mode:
-                        step_mode = True
-                    else:
-                        await next_step()
-                elif key == 14:
-                    if modifier1_pressed:
-                        notes_per_beat += 1
-                        if notes_per_beat > 4:
-                            notes_per_beat = 0
-                    else:
-                        if recording:
-                            n, v, l, m = await get_step_data(track, step)
-                            l += 1
-                            if l > 4:
-                                l = 0
-
-                            await set_step_data(track, step, (n, v, l, m))
-                elif key == 15:
-                    if modifier1_pressed:
-                        octave += 1
-                    elif modifier2_pressed:
-                        current_channel += 1
-                    elif not recording:
-                        tempo += 1
-                    else:
-                        track += 1
-                elif key == 16:
-                    modifier1_pressed = True
-                elif key == 17:
-                    modifier2_pressed = True
-                elif key == 18:
-                    if recording:
-                        n, v, l, m = await get_step_data(track, step)
-                        m += 1
-                        if m > 2:
-                            m = 0
-
-                        await set_step_data(track, step, (n, v, l, m))
-                elif key == 19:
-                    if modifier1_pressed:
-                        octave -= 1
-                    elif modifier2_pressed:
-                        current_channel -= 1
-                    elif not recording:
-                        tempo -= 1
-                    else:
-                        track -= 1
-
-                if key == 15 or key == 19:
-                    if modifier1_pressed:
-                        if octave < 0:
-                            octave = 9
-                        elif octave > 9:
-                            octave = 0
-                    elif modifier2_pressed:
-                        if current_channel < 0:
-                            current_channel = 15
-                        elif current_channel > 15:
-                            current_channel = 0
-                    elif not recording:
-                        if tempo < 0:
-                            tempo = 0
-                        elif tempo > 240:
-                            tempo = 240
-                    else:
-                        if track < 0:
-                            track = tracks - 1
-                        elif track >= tracks:
-                            track = 0
-            elif e.released:
-                if key == 16:
-                    modifier1_pressed = False
-                if key == 17:
-                    modifier2_pressed = False
-
-        await update_application_data(tempo, octave, recording, step_mode, track, current_channel, notes_per_beat)
-        await asyncio.sleep_ms(10)
 
+def key_tempo_up():
+    global _tempo
+    _tempo = min(_tempo + 1, 240)
 
-async def sequencer_routine():
-    while True:
-        tempo, octave, step, steps, track, tracks, recording, step_mode, current_channel, notes_per_beat = await get_application_data()
-        tasks = []
 
-        if recording:
-            await asyncio.sleep_ms(33)
+def key_tempo_down():
+    global _tempo
+    _tempo = max(_tempo - 1, 1)
+
+
+def key_track_up():
+    global _track
+    _track = (_track + 1) % _tracks
+
+
+def key_track_down():
+    global _track
+    _track = (_track - 1) % _tracks
+
+
+def key_octave_up():
+    global _octave
+    _octave = (_octave + 1) % 10
+
+
+def key_octave_down():
+    global _octave
+    _octave = (_octave - 1) % 10
+
+
+def key_tracks_up():
+    global _tracks, _pattern_version
+    _tracks = _tracks % _MAX_TRACKS + 1
+    _pattern_version += 1
+
+
+def key_tracks_down():
+    global _tracks, _track, _pattern_version
+    _tracks = (_tracks - 2) % _MAX_TRACKS + 1
+    if _track >= _tracks:
+        _track = _tracks - 1
+    _pattern_version += 1
+
+
+def set_track_length(length):
+    global _pattern_version
+    _track_length[_track] = length
+    _pattern_version += 1
+    if _track_pos[_track] >= length:
+        _track_pos[_track] = 0
+
+
+def key_length_up():
+    set_track_length(_track_length[_track] % _MAX_STEPS + 1)
+
+
+def key_length_down():
+    set_track_length((_track_length[_track] - 2) % _MAX_STEPS + 1)
+
+
+def key_channel_up():
+    _channels[_track] = (_channels[_track] + 1) & 0x0F
+
+
+def key_channel_down():
+    _channels[_track] = (_channels[_track] - 1) & 0x0F
+
+
+def select_bank(bank):
+    global _bank, _pattern
+    _bank = bank
+    _pattern = _banks[bank]
+    if not _song:
+        cue_bank(bank)
+
+
+def key_bank_up():
+    select_bank((_bank + 1) % _BANKS)
+
+
+def key_bank_down():
+    select_bank((_bank - 1) % _BANKS)
+
+
+def key_chain_add():
+    global _chain_length
+    if _chain_length < _CHAIN_SIZE:
+        _chain[_chain_length] = _bank
+        _chain_length += 1
+
+
+def key_chain_clear():
+    global _chain_length, _song
+    _chain_length = 0
+    _song = False
+    cue_bank(_bank)
+
+
+def key_song():
+    global _song, _chain_pos
+    if _song:
+        _song = False
+        cue_bank(_bank)
+    elif _chain_length:
+        # The chain starts with the next bar
+        _song = True
+        _chain_pos = _chain_length - 1
+        cue_bank(_chain[0])
+
+
+_KEY_ACTIONS = (
+    # Play mode
+    ((key_record, key_step, key_bank_up, key_tempo_up, None, None, key_bank_down, key_tempo_down),
+     (key_reset_track, key_step, key_steps_per_beat, key_octave_up, None, None, key_swing, key_octave_down),
+     (all_notes_off, key_step, key_profiling, key_channel_up, None, None, hist_print, key_channel_down),
+     (key_song, key_chain_clear, key_tracks_up, key_length_up, None, None, key_tracks_down, key_length_down)),
+    # Record mode
+    ((key_record, key_step, key_length, key_track_up, None, None, key_note_mode, key_track_down),
+     (key_reset_track, key_gate, key_steps_per_beat, key_octave_up, None, None, key_nudge, key_octave_down),
+     (all_notes_off, key_ramp, key_profiling, key_channel_up, None, None, hist_print, key_channel_down),
+     (key_bank_up, key_chain_add, key_tracks_up, key_length_up, None, None, key_tracks_down, key_length_down)),
+)
+# The sequencer drains the key events at least every _MIDI_IN_POLL_MS.
+# _key_latency is the time from the scan that saw the last piano key press
+# to its note on leaving.
+_modifier1 = False
+_modifier2 = False
+_key_latency = 0
+_max_key_latency = 0
+# Notes recorded that are still held, one bit per note. A note recorded
+# while another one is held joins the chord of the step at _chord_at.
+_chord_held = bytearray(16)
+_chord_count = 0
+_chord_at = -1
+
+
+def record_note(note, vel):
+    global _chord_count, _chord_at
+    pos = _track_pos[_track]
+    at = (_bank * _MAX_TRACKS + _track) * _MAX_STEPS + pos
+    if _chord_count and at == _chord_at and step_get(_track, pos, _F_NOTE) != _NO_NOTE:
+        add_chord_note(_track, pos, note)
+    else:
+        set_step(_track, pos, note, vel, 0, 0)
+        _chord_at = at
+    if not _chord_held[note >> 3] & (1 << (note & 7)):
+        _chord_held[note >> 3] |= 1 << (note & 7)
+        _chord_count += 1
+    touch_state()
+
+
+def release_note(note):
+    global _chord_count
+    if _chord_held[note >> 3] & (1 << (note & 7)):
+        _chord_held[note >> 3] &= ~(1 << (note & 7))
+        _chord_count -= 1
+
+
+def piano_key(key, pressed, timestamp):
+    global _key_latency, _max_key_latency
+    if pressed:
+        # The note off must match even if the octave, track or channel
+        # changes while the key is held
+        note = key + _octave * 12
+        _held_note[key] = note
+        _held_channel[key] = _channels[_track]
+        send_note_on(note, 127, _channels[_track])
+        _key_latency = ticks_diff(ticks_ms(), timestamp)
+        if _key_latency > _max_key_latency:
+            _max_key_latency = _key_latency
+        if _profiling:
+            hist_add(_HIST_KEY, _key_latency)
+
+        if _recording:
+            record_note(note, 127)
+    elif _held_note[key] != _NO_NOTE:
+        send_note_off(_held_note[key], _held_channel[key])
+        release_note(_held_note[key])
+        _held_note[key] = _NO_NOTE
+
+
+def poll_keys():
+    global _modifier1, _modifier2
+    e = _key_event
+    while keyboard.events.get_into(e):
+        key = keymap[e.key_number]
+        if key < 12:
+            piano_key(key, e.pressed, e.timestamp)
+        elif key == 16:
+            _modifier1 = e.pressed
+        elif key == 17:
+            _modifier2 = e.pressed
+        elif e.pressed:
+            action = _KEY_ACTIONS[1 if _recording else 0][
+                (1 if _modifier1 else 0) + (2 if _modifier2 else 0)][key - 12]
+            if action is not None:
+                action()
+                touch_state()
+
+
+def sequencer_free_ms(now):
+    # Time until the sequencer needs the CPU again
+    free = 1000
+    if _clock_running or _sync_steps_left or (
+            _clk_ticks and _midi_transport == _TRANSPORT_PLAYING):
+        free = ticks_diff(_step_deadline, now)
+    if _event_count:
+        free = min(free, ticks_diff(_event_time[0], now))
+    if clock_out_pending():
+        free = min(free, ticks_diff(clock_out_due(), now))
+    return free
+
+
+_step_remainder = 0
+
+
+def step_period(tempo, notes_per_beat):
+    # Step length is 60000 / (tempo * 2^npb) ms, the fractional part is carried
+    # in _step_remainder so that the grid never drifts from the displayed BPM.
+    # No tuples, the hot path must not allocate.
+    global _step_remainder
+    divisor = tempo << notes_per_beat
+    period = 60000 // divisor
+    _step_remainder += 60000 - period * divisor
+    if _step_remainder >= divisor:
+        period += _step_remainder // divisor
+        _step_remainder %= divisor
+    return period
+
+
+# MIDI clock input. The sequencer polls both inputs at least every
+# _MIDI_IN_POLL_MS and each clock tick is timestamped when read. The tick times feed a phase locked
+# loop that keeps a filtered estimate of the tick period (_clk_period) and of
+# the time of the last tick (_clk_time plus _clk_frac), both in 1/256 ms.
+# Steps are placed on the filtered tick grid, so the master's jitter does not
+# reach our notes. While following, _clock_tempo is the estimated tempo,
+# it is shown instead of _tempo but never replaces or saves it.
+_MIDI_IN_POLL_MS = 2
+_MIDI_CLOCK_TIMEOUT_MS = 2000
+_CLK_PHASE_SHIFT = 3
+_CLK_PERIOD_SHIFT = 6
+_CLK_LOCK_ERROR = 256
+_CLK_LOCK_TICKS = 24
+# Once locked the display shows the phase error every _CLK_SHOW_TICKS ticks
+_CLK_SHOW_TICKS = 24
+
+_TRANSPORT_OFF = 0
+_TRANSPORT_STOPPED = 1
+_TRANSPORT_PLAYING = 2
+
+_midi_in = bytearray(32)
+_midi_transport = _TRANSPORT_OFF
+_clk_ticks = 0
+_clk_first = 0
+_clk_time = 0
+_clk_frac = 0
+_clk_period = 0
+_clk_started = 0
+_clk_good_ticks = 0
+_clk_position = 0
+_clock_lock_ms = -1
+_clock_phase_error = 0
+_clock_jitter = 0
+_clock_tempo = 120
+
+
+def midi_clock_tick(now):
+    global _clk_ticks, _clk_first, _clk_time, _clk_frac, _clk_period, _clk_good_ticks, _clock_lock_ms, _clock_phase_error, _clock_jitter, _clock_tempo
+    if _clk_ticks == 0:
+        _clk_first = now
+        _clk_time = now
+        _clk_frac = 0
+        if not _clk_period:
+            _clk_period = 60000 * 256 // (_tempo * 24)
+    else:
+        if _clk_ticks < _CLK_LOCK_TICKS:
+            # Acquire with the mean interval so far, then track with the
+            # loop filter alone
+            _clk_period = max(1, ticks_diff(now, _clk_first)) * 256 // _clk_ticks
+        frac = _clk_frac + _clk_period
+        error = ticks_diff(now, _clk_time) * 256 - frac
+        frac += error >> _CLK_PHASE_SHIFT
+        _clk_period += error >> _CLK_PERIOD_SHIFT
+        _clk_time = ticks_add(_clk_time, frac >> 8)
+        _clk_frac = frac & 0xFF
+
+        # The mean of the error is our phase offset from the master, its
+        # mean magnitude is the jitter of the incoming ticks
+        _clock_phase_error += (error - _clock_phase_error) >> 4
+        _clock_jitter += (abs(error) - _clock_jitter) >> 4
+        if _clock_lock_ms < 0:
+            if abs(_clock_phase_error) < _CLK_LOCK_ERROR:
+                _clk_good_ticks += 1
+            else:
+                _clk_good_ticks = 0
+            if _clk_good_ticks >= _CLK_LOCK_TICKS:
+                _clock_lock_ms = ticks_diff(now, _clk_started)
+                touch_state()
+        elif _clk_ticks % _CLK_SHOW_TICKS == 0:
+            touch_state()
+    _clk_ticks += 1
+
+    tempo = max(1, (60000 * 256 + _clk_period * 12) // (_clk_period * 24))
+    if tempo != _clock_tempo:
+        _clock_tempo = tempo
+        touch_state()
+
+
+def midi_transport(status, now):
+    global _midi_transport, _clk_ticks, _clk_position, _clk_good_ticks, _clock_lock_ms, _clk_started
+    global _clock_phase_error, _clock_jitter
+    if status == 0xFA or status == 0xFB:
+        if status == 0xFA:
+            rewind()
+        # Playback restarts on the next clock tick
+        _midi_transport = _TRANSPORT_PLAYING
+        _clk_ticks = 0
+        _clk_position = 0
+        _clk_good_ticks = 0
+        _clock_lock_ms = -1
+        _clock_phase_error = 0
+        _clock_jitter = 0
+        _clk_started = now
+    elif status == 0xFC:
+        if _midi_transport == _TRANSPORT_OFF:
+            # Only Start or Continue hand playback to a master
+            return
+        _midi_transport = _TRANSPORT_STOPPED
+        all_notes_off()
+    touch_state()
+
+
+# Incoming notes are recorded into the selected step and sent on to both
+# outputs on the selected track's channel. Every input has its own parser
+# state: running status, the first data byte of a message in progress and
+# whether it is inside a SysEx message. Realtime bytes are handled wherever
+# they appear. The receive rings of the UART and USB drivers buffer bursts,
+# each poll parses at most one _midi_in of bytes per input so a chord never
+# holds up the next step.
+_MIDI_THRU = True
+_IN_UART = 0
+_IN_USB = 1
+_in_status = bytearray(2)
+_in_data1 = bytearray(2)
+_in_count = bytearray(2)
+# Channel each incoming note was sent on, so its note off follows it
+_thru_channel = bytearray(128)
+
+
+def midi_message(status, data1, data2):
+    kind = status & 0xF0
+    if kind == 0x90 and data2:
+        ch = _channels[_track]
+        _thru_channel[data1] = ch
+        if _MIDI_THRU:
+            queue_midi(0x90 | ch, data1, data2)
+        if _recording:
+            record_note(data1, data2)
+    elif kind == 0x80 or kind == 0x90:
+        release_note(data1)
+        if _MIDI_THRU:
+            queue_midi(0x80 | _thru_channel[data1], data1, 0)
+
+
+def midi_input(port, data, n, now):
+    status = _in_status[port]
+    count = _in_count[port]
+    for i in range(n):
+        b = data[i]
+        if b >= 0xF8:
+            if b == 0xF8:
+                if _midi_transport == _TRANSPORT_PLAYING:
+                    midi_clock_tick(now)
+            elif b == 0xFA or b == 0xFB or b == 0xFC:
+                midi_transport(b, now)
+            continue
+        if b & 0x80:
+            # SysEx keeps status 0xF0 until its end, its data is skipped
+            status = b
+            if b != 0xF0 and midi_length(b) == 1:
+                # End of SysEx, tune request and undefined ones carry no data
+                status = 0
+            count = 0
             continue
+        if status == 0 or status == 0xF0:
+            continue
+        if count == 0 and midi_length(status) == 3:
+            _in_data1[port] = b
+            count = 1
+            continue
+        count = 0
+        if midi_length(status) == 3:
+            midi_message(status, _in_data1[port], b)
+        else:
+            midi_message(status, b, 0)
+        if status >= 0xF0:
+            # System common messages have no running status
+            status = 0
+    _in_status[port] = status
+    _in_count[port] = count
+
+
+def release_midi_clock():
+    global _midi_transport
+    _midi_transport = _TRANSPORT_OFF
+
+
+def midi_clock_deadline():
+    # Predicted time of the next step on the filtered tick grid, steps are
+    # 48 >> npb half ticks long
+    ahead = (_clk_position - 2 * (_clk_ticks - 1)) * _clk_period // 2
+    return ticks_add(_clk_time, (_clk_frac + ahead) >> 8)
+
+
+def poll_midi_input(now):
+    global _midi_transport
+    n = uart_midi.readinto(_midi_in)
+    if n:
+        midi_input(_IN_UART, _midi_in, n, now)
+    m = usb_midi_in.readinto(_midi_in)
+    if m:
+        midi_input(_IN_USB, _midi_in, m, now)
+    if n or m:
+        flush_midi()
+    if (_midi_transport == _TRANSPORT_PLAYING and _clk_ticks
+            and ticks_diff(now, _clk_time) > _MIDI_CLOCK_TIMEOUT_MS):
+        # The master went away without sending Stop
+        _midi_transport = _TRANSPORT_STOPPED
+        touch_state()
+
+
+def sync_pulse(timestamp):
+    global _sync_pulses, _sync_last_pulse, _sync_step_period, _sync_steps_left, _step_deadline
+    _sync_pulses += 1
+    if _sync_pulses < _SYNC_PULSES_PER_STEP:
+        return
+    _sync_pulses = 0
+    if _sync_last_pulse is not None:
+        _sync_step_period = ticks_diff(
+            timestamp, _sync_last_pulse) // _SYNC_STEPS_PER_PULSE
+    _sync_last_pulse = timestamp
+    _step_deadline = ticks_add(timestamp, _SYNC_LATENCY_MS)
+    _sync_steps_left = _SYNC_STEPS_PER_PULSE
 
-        target_step_time = 60000 // tempo // (2 ** notes_per_beat)
-
-        for i in range(tracks):
-            step_data = await get_step_data(i, step)
-            if not step_data[0] == -1:
-                if step_data[3] == 1:
-                    tasks.append(send_note_doublet(step_data[0], step_data[1], int(
-                        target_step_time / (2 ** step_data[2]))))
-                elif step_data[3] == 2:
-                    tasks.append(send_note_triplet(step_data[0], step_data[1], int(
-                        target_step_time / (2 ** step_data[2]))))
-                else:
-                    tasks.append(send_note(step_data[0], step_data[1], int(
-                        target_step_time / (2 ** step_data[2]))))
 
-        await next_step()
-        if not step_mode:
-            tasks.append(wait(target_step_time))
+async def sequencer_routine():
+    global _step_deadline, _step_lateness, _max_step_lateness, _clock_resyncs, _clock_running
+    global _sync_pulses, _sync_last_pulse, _sync_steps_left, _clk_position, _step_remainder
+    global _gc_pending, _ahead
+    syncing = False
+    seen_version = saved_version = _state_version
+    changed_at = ticks_ms()
+    _step_deadline = ticks_ms()
+    while True:
+        started = time.monotonic_ns() if _profiling else 0
+        now = ticks_ms()
+        poll_midi_input(now)
+        following = _midi_transport != _TRANSPORT_OFF
+        running = not (_recording or _step_mode or following)
+        if running and not _clock_running:
+            # Playback resumes, the first step is due right away
+            _step_deadline = now
+            _step_remainder = 0
+            if _MIDI_CLOCK_OUT:
+                send_transport_start(_step, _notes_per_beat)
+        elif _clock_running and not running:
+            all_notes_off()
+            if _MIDI_CLOCK_OUT:
+                send_transport_stop()
+        _clock_running = running
+
+        if _step_mode and not _recording:
+            if not syncing:
+                # Pulses from before step mode are stale
+                _sync_keys.events.clear()
+                _sync_pulses = 0
+                _sync_last_pulse = None
+                _sync_steps_left = 0
+                syncing = True
+            while _sync_keys.events.get_into(_sync_event):
+                if _sync_event.pressed:
+                    sync_pulse(_sync_event.timestamp)
+        else:
+            syncing = False
+
+        if running or _sync_steps_left:
+            step_due = ticks_diff(now, _step_deadline) >= 0
+        elif following and _clk_ticks and _midi_transport == _TRANSPORT_PLAYING and not (_recording or _step_mode):
+            _step_deadline = midi_clock_deadline()
+            step_due = ticks_diff(now, _step_deadline) >= 0
         else:
-            tasks.append(wait_for_trigger())
-        await asyncio.gather(*tasks)
+            step_due = False
+
+        if step_due:
+            target_step_time = step_period(_tempo, _notes_per_beat)
+            if syncing:
+                _sync_steps_left -= 1
+                if _sync_step_period:
+                    target_step_time = _sync_step_period
+            elif following:
+                half_ticks = 48 >> _notes_per_beat
+                target_step_time = (_clk_period * half_ticks) >> 9
+                _clk_position += half_ticks
+
+            _step_lateness = ticks_diff(now, _step_deadline)
+            if _step_lateness > _max_step_lateness:
+                _max_step_lateness = _step_lateness
+            if _profiling:
+                hist_add(_HIST_LATE, _step_lateness)
+            if _step_lateness > target_step_time:
+                # More than a whole step behind, resync instead of bursting steps
+                _step_deadline = now
+                _clock_resyncs += 1
+                if following:
+                    _clk_position = 2 * _clk_ticks
+
+            if running and _MIDI_CLOCK_OUT:
+                clock_out_step(_step_deadline, target_step_time,
+                               48 >> _notes_per_beat)
+
+            # Notes are timed from the deadline, not from when we woke up.
+            # The notes nudged ahead of this step went out with the last one.
+            tempo = _clock_tempo if following else _tempo
+            if tempo != _tick_tempo or _notes_per_beat != _tick_npb:
+                tick_table(tempo)
+            schedule_tracks(_step_deadline, target_step_time, not _ahead, True)
+
+            if _step == 0:
+                _gc_pending = True
+            next_step()
+            # Every step is scheduled against an absolute deadline, time lost
+            # anywhere else is paid back by a shorter sleep
+            _step_deadline = ticks_add(_step_deadline, target_step_time)
+            # Pulses give no warning of the next step
+            _ahead = not syncing
+            if _ahead:
+                schedule_tracks(_step_deadline, target_step_time, True, False)
+
+        now = ticks_ms()
+        dispatch_clock(now)
+        dispatch_events(now)
+        poll_keys()
+
+        if not running and ticks_diff(now, _gc_last) >= _GC_IDLE_MS:
+            _gc_pending = True
+        if _gc_pending and sequencer_free_ms(now) >= _GC_GAP_MS:
+            collect_garbage(now)
+            now = ticks_ms()
+
+        if _state_version != seen_version:
+            seen_version = _state_version
+            changed_at = now
+        elif (saved_version != _state_version and ticks_diff(now, changed_at) >= _SAVE_DELAY_MS
+              and not (running or syncing or _event_count or _midi_transport == _TRANSPORT_PLAYING)):
+            save_state()
+            saved_version = _state_version
+            now = ticks_ms()
+
+        # The loop wakes at least every _MIDI_IN_POLL_MS to read the keys, the
+        # sync queue and the MIDI inputs, earlier for the next step, the next
+        # queued note on/off or the next clock tick
+        delay = _MIDI_IN_POLL_MS
+        if running or _sync_steps_left:
+            delay = min(delay, ticks_diff(_step_deadline, now))
+        elif following and _clk_ticks and _midi_transport == _TRANSPORT_PLAYING:
+            delay = min(delay, ticks_diff(midi_clock_deadline(), now))
+        if _event_count:
+            delay = min(delay, ticks_diff(_event_time[0], now))
+        if clock_out_pending():
+            delay = min(delay, ticks_diff(clock_out_due(), now))
+        if started:
+            hist_since(_HIST_PASS, started)
+        await asyncio.sleep_ms(delay)
 
 
 async def main():
-    input_task = asyncio.create_task(handle_input())
+    gc.collect()
+    print("{} bytes of heap free".format(gc.mem_free()))
     display_task = asyncio.create_task(update_display())
     sequencer_task = asyncio.create_task(sequencer_routine())
+    uart_task = asyncio.create_task(uart_drain())
 
-    await asyncio.gather(sequencer_task, display_task, input_task)
+    await asyncio.gather(sequencer_task, display_task, uart_task)
 
 asyncio.run(main())